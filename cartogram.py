@@ -1,25 +1,35 @@
 from PyQt4.QtCore import (Qt, QCoreApplication, QPyNullVariant, QSettings,
-    QThread, QTranslator, qVersion)
+    QThread, QTranslator, QVariant, qVersion)
 from PyQt4.QtGui import (QAction, QPushButton, QDialog, QIcon, QLabel,
     QMessageBox, QProgressBar)
-from qgis.core import (QGis, QgsDistanceArea, QgsGeometry, QgsMapLayer,
-    QgsMapLayerRegistry, QgsMessageLog, QgsPoint, QgsVectorFileWriter,
-    QgsVectorLayer, QgsProject)
+from qgis.core import (QGis, QgsApplication, QgsDistanceArea,
+    QgsFeature, QgsFeatureRequest, QgsField, QgsGeometry, QgsMapLayer,
+    QgsMapLayerRegistry, QgsMessageLog, QgsPoint, QgsVectorLayer,
+    QgsProject)
 from qgis.gui import QgsFieldProxyModel, QgsMapLayerProxyModel, QgsMessageBar
+from qgis.utils import pluginMetadata
 
+from cartogram_cache import ResultCache
 from cartogram_dialog import CartogramDialog
-from cartogram_worker import CartogramWorker
+from cartogram_export import available_formats, export_path
+from cartogram_worker import AnimationWorker, CartogramWorker
+
+from datetime import datetime
 
 import math
 import os.path
 import resources_rc
 
+# number of features added to the memory layer at once
+COPY_BATCH_SIZE = 10000
+
+# number of vertices of the preview of intermediate iterations
+PREVIEW_VERTICES = 100000
+
 
 class Cartogram:
     """QGIS Plugin Implementation."""
 
-    workers=[]
-
     def __init__(self, iface):
         """Constructor.
 
@@ -52,6 +62,7 @@ class Cartogram:
         # declare instance attributes
         self.action = None
         self.menu = self.tr('&Cartogram')
+        self.preview_layer = None
 
     def initGui(self):
         """Create the menu entries and toolbar icons inside the QGIS GUI."""
@@ -106,6 +117,14 @@ class Cartogram:
         currentLayer = self.dialog.sourceLayerCombo.currentLayer()
         self.dialog.sourceLayerCombo.layerChanged.emit(currentLayer)
 
+        # the formats the cartogram can be exported to
+        self.dialog.exportFormatCombo.addItem(self.tr('Do not export'), None)
+        formats = available_formats()
+        for (driver, (name, extension)) in formats.items():
+            self.dialog.exportFormatCombo.addItem(name, driver)
+        self.dialog.exportFormatCombo.setCurrentIndex(
+            1 + formats.keys().index('GPKG') if 'GPKG' in formats else 0)
+
         # connect some odds and ends
         self.dialog.buttonBox.accepted.connect(self.validate)
 
@@ -119,27 +138,92 @@ class Cartogram:
         input_layer = self.get_vector_layer_by_name(input_layer_name)
         input_field = self.dialog.sourceFieldCombo.currentText()
         iterations = self.dialog.iterationsSpinBox.value()
+        options = {
+            "theta": self.dialog.thetaSpinBox.value(),
+            "tolerance": self.dialog.toleranceSpinBox.value(),
+            "grid_size": self.dialog.gridSpinBox.value(),
+            "snap": self.dialog.snapSpinBox.value(),
+            "coarse_vertices": self.dialog.coarseSpinBox.value(),
+            "target_mean_error": self.dialog.meanErrorSpinBox.value(),
+            "target_max_error": self.dialog.maxErrorSpinBox.value(),
+            "checkpoint_interval": self.dialog.checkpointSpinBox.value()
+        }
+
+        copy_attributes = self.dialog.copyAttributesCheckBox.isChecked()
+        stream = self.dialog.streamCheckBox.isChecked()
+
+        # the export file is written by the worker, straight from the
+        # transformed coordinates; a precision of -1 keeps all decimals
+        export_driver = self.dialog.exportFormatCombo.itemData(
+            self.dialog.exportFormatCombo.currentIndex())
+        if export_driver is not None:
+            options["export_driver"] = export_driver
+        if self.dialog.precisionSpinBox.value() >= 0:
+            options["precision"] = self.dialog.precisionSpinBox.value()
+
+        data_directory = os.path.join(QgsApplication.qgisSettingsDirPath(),
+            'cartogram')
+
+        # results are cached per job, so running the same job again (or with
+        # more iterations, or after it was cancelled) continues where the last
+        # run stopped; a checkpoint interval of 0 turns the checkpoints off
+        options["cache"] = ResultCache(os.path.join(data_directory, 'cache'),
+            version=pluginMetadata(os.path.basename(self.plugin_dir),
+                'version'))
+
+        # the timings of every job are logged as JSON lines; setting
+        # cartogram/profileIteration profiles that iteration as well
+        log_name = os.path.join(data_directory, 'logs',
+            datetime.now().strftime('cartogram-%Y%m%d-%H%M%S'))
+        options["log_path"] = log_name + '.jsonl'
+        profile_iteration = QSettings().value('cartogram/profileIteration', 0,
+            type=int)
+        if profile_iteration > 0:
+            options["profile_iteration"] = profile_iteration
+            options["profile_path"] = log_name + '.prof'
+
+        # cartogram/backend selects the force kernel (numpy or numba), e.g.
+        # to compare them; by default Numba is used if it is installed
+        backend = QSettings().value('cartogram/backend', '', type=str)
+        if backend:
+            options["backend"] = backend
 
         anim_fields = [f.name() for f in input_layer.fields().toList() if f.name()[:4]=="anim"]
         if len(anim_fields)>1 and input_field[:4]=="anim":
-            for anim_field in anim_fields:
-                memory_layer = self.create_memory_layer(input_layer,anim_field)
-                self.workers.append({
-                    "layer":memory_layer,
-                    "fieldName":anim_field,
-                    "iterations":iterations
-                })
-            firstWorker=self.workers.pop()
-            self.worker_start(
-                firstWorker["layer"],
-                firstWorker["fieldName"],
-                firstWorker["iterations"]
-            )
-            
+            # the frames are independent and created in parallel by a single
+            # worker, which reads the source layer only once
+            if export_driver is not None:
+                options["export_path"] = export_path(
+                    QgsProject.instance().homePath(), 'cartogram_animation',
+                    export_driver)
+            jobs = [self.create_job(input_layer, anim_field, iterations,
+                options, copy_attributes, stream)
+                for anim_field in anim_fields]
+            worker = AnimationWorker([job["layer"] for job in jobs],
+                anim_fields, iterations,
+                [job["outputLayer"] for job in jobs],
+                warm_start=self.dialog.warmStartCheckBox.isChecked(),
+                stream=stream, **options)
         else:
-            memory_layer = self.create_memory_layer(input_layer,input_field)
-            self.worker_start(memory_layer, input_field, iterations)
-
+            if export_driver is not None:
+                options["export_path"] = export_path(
+                    QgsProject.instance().homePath(),
+                    'cartogram_{}'.format(input_field), export_driver)
+
+                # the displacement grid transforms other layers alike
+                if options["grid_size"] > 0:
+                    options["grid_path"] = os.path.join(
+                        QgsProject.instance().homePath(),
+                        'cartogram_{}_grid.npz'.format(input_field))
+            job = self.create_job(input_layer, input_field, iterations,
+                options, copy_attributes, stream)
+            worker = CartogramWorker(job["layer"], job["fieldName"],
+                job["iterations"], job["outputLayer"], stream=stream,
+                preview_vertices=PREVIEW_VERTICES
+                    if self.dialog.previewCheckBox.isChecked() else 0,
+                **job["options"])
+
+        self.worker_start(worker)
 
     def demo(self):
         path = os.path.join(self.plugin_dir, 'demo', 'demo.shp')
@@ -147,10 +231,35 @@ class Cartogram:
         layer = QgsVectorLayer(path, 'Cartogram demo layer', 'ogr')
         QgsMapLayerRegistry.instance().addMapLayer(layer)
 
-    def worker_start(self, layer, field_name, iterations):
-        """Start a worker instance on a background thread."""
+    def create_job(self, layer, field_name, iterations, options,
+        copy_attributes, stream=False):
+        """Prepare the layers a worker needs to create one cartogram.
 
-        worker = CartogramWorker(layer, field_name, iterations)
+        When all attributes are copied the worker transforms a full in-memory
+        copy of the source layer. Otherwise it reads the source layer directly
+        and fills an empty layer with only an id and the value field. When
+        streaming, no layer is held in memory at all: the worker reads the
+        source layer directly and only writes the export file.
+        """
+
+        output_layer = None
+        if not stream:
+            if copy_attributes:
+                layer = self.create_memory_layer(layer, field_name)
+            else:
+                output_layer = self.create_memory_layer(layer, field_name,
+                    False)
+
+        return {
+            "layer":layer,
+            "fieldName":field_name,
+            "iterations":iterations,
+            "options":options,
+            "outputLayer":output_layer
+        }
+
+    def worker_start(self, worker):
+        """Start a worker instance on a background thread."""
 
         message_bar = self.iface.messageBar().createMessage('')
 
@@ -159,7 +268,7 @@ class Cartogram:
 
         progress_bar = QProgressBar()
         progress_bar.setAlignment(Qt.AlignLeft | Qt.AlignVCenter)
-        progress_bar.setMaximum(iterations * layer.featureCount())
+        progress_bar.setMaximum(100)
 
         cancel_button = QPushButton()
         cancel_button.setText(self.tr('Cancel'))
@@ -167,6 +276,16 @@ class Cartogram:
 
         message_bar.layout().addWidget(label)
         message_bar.layout().addWidget(progress_bar)
+
+        # with a preview, the user may decide that the cartogram is good
+        # enough before all iterations are done
+        if worker.preview_vertices > 0:
+            finish_button = QPushButton()
+            finish_button.setText(self.tr('Finish now'))
+            finish_button.clicked.connect(worker.finish)
+            message_bar.layout().addWidget(finish_button)
+            worker.preview.connect(self.worker_preview)
+
         message_bar.layout().addWidget(cancel_button)
 
         self.iface.messageBar().pushWidget(message_bar,
@@ -182,6 +301,7 @@ class Cartogram:
         worker.error.connect(self.worker_error)
         worker.progress.connect(progress_bar.setValue)
         worker.feedback.connect(self.worker_feedback)
+        worker.statistics.connect(self.worker_statistics)
         thread.started.connect(worker.run)
 
         thread.start()
@@ -200,31 +320,65 @@ class Cartogram:
 
         self.iface.messageBar().popWidget(self.message_bar)
 
-        #for intermediateLayer in intermediateLayers:
-        #    QgsMapLayerRegistry.instance().addMapLayer(intermediateLayers)
+        if self.preview_layer is not None:
+            QgsMapLayerRegistry.instance().removeMapLayer(
+                self.preview_layer.id())
+            self.preview_layer = None
+
+        # animation workers return one layer per frame
+        layers = layer if isinstance(layer, list) else [layer]
 
         if layer is not None:
-            QgsMapLayerRegistry.instance().addMapLayer(layer)
-            QgsVectorFileWriter.writeAsVectorFormat(
-                layer,
-                os.path.join(QgsProject.instance().homePath(),layer.name()+".shp"),
-                "utf-8", 
-                None, 
-                "ESRI Shapefile"
-            )
+            for (frame, layer) in enumerate(layers):
+                # streamed cartograms only exist as the export file, in which
+                # the frames of an animation are told apart by an attribute
+                if isinstance(layer, basestring):
+                    name = os.path.splitext(os.path.basename(layer))[0]
+                    if len(layers) > 1:
+                        name = u'{} #{}'.format(name, frame + 1)
+                    layer = QgsVectorLayer(layer, name, 'ogr')
+                    if len(layers) > 1:
+                        layer.setSubsetString(u'"frame" = {}'.format(frame))
+
+                QgsMapLayerRegistry.instance().addMapLayer(layer)
         else:
             if (exit_code == 1):
                 message = self.tr('Cartogram creation cancelled by user.')
                 self.iface.messageBar().pushMessage(message,
                     level=QgsMessageBar.INFO, duration=3)
 
-        if len(self.workers) > 0:
-            worker=self.workers.pop()
-            self.worker_start(
-                worker["layer"],
-                worker["fieldName"],
-                worker["iterations"]
-            )
+    def worker_preview(self, iterations, geometries):
+        """Show the outline of the features after an intermediate iteration.
+
+        A single memory layer without any attributes holds the preview; its
+        geometries are replaced by those of each new snapshot.
+        """
+
+        if self.preview_layer is None:
+            layer = QgsVectorLayer('MultiPolygon?crs={}'.format(
+                self.worker.layer.crs().authid()), 'cartogram preview',
+                'memory')
+            features = []
+            for (index, geometry) in geometries:
+                feature = QgsFeature()
+                feature.setGeometry(geometry)
+                features.append(feature)
+            (result, features) = layer.dataProvider().addFeatures(features)
+            self.preview_ids = dict((index, feature.id()) for
+                ((index, geometry), feature) in zip(geometries, features))
+
+            QgsMapLayerRegistry.instance().addMapLayer(layer)
+            self.preview_layer = layer
+        else:
+            self.preview_layer.dataProvider().changeGeometryValues(dict(
+                (self.preview_ids[index], geometry)
+                for (index, geometry) in geometries
+                if index in self.preview_ids))
+
+        self.preview_layer.setLayerName(self.tr('cartogram preview '
+            '(iteration {})').format(iterations))
+        self.preview_layer.updateExtents()
+        self.preview_layer.triggerRepaint()
 
     def worker_error(self, e, exception_string):
         message = self.tr('An error ocurred during cartogram creation. '
@@ -239,6 +393,21 @@ class Cartogram:
     def worker_feedback(self,msg):
         QgsMessageLog.logMessage(msg)
 
+    def worker_statistics(self, record):
+        """Log the wall clock time of the stages of an iteration or a job."""
+
+        stages = u', '.join(u'{} {:.3f}s'.format(stage, times['wall'])
+            for (stage, times) in sorted(record['stages'].items()))
+        if record['type'] == 'iteration':
+            message = u'iteration {} of {}: {}, {:.0f} vertices/s'.format(
+                record['iteration'], record['field'], stages,
+                record['throughput'])
+        else:
+            message = u'{} {}: {}'.format(record['type'], record['field'],
+                stages)
+
+        QgsMessageLog.logMessage(message)
+
     def validate(self):
         """Make sure that all fields have valid values."""
         message = ''
@@ -246,6 +415,10 @@ class Cartogram:
             message += self.tr('Please select an input layer.')
         if not self.dialog.sourceFieldCombo.currentText():
             message += self.tr('Please select an area field.')
+        if self.dialog.streamCheckBox.isChecked() and \
+            self.dialog.exportFormatCombo.currentIndex() == 0:
+            message += self.tr('Please select an export format, streamed '
+                'cartograms are only written to a file.')
 
         if message:
             QMessageBox.warning(self.dialog, 'Cartogram', message)
@@ -255,13 +428,20 @@ class Cartogram:
             layer = self.get_vector_layer_by_name(layer_name)
             field = self.dialog.sourceFieldCombo.currentText()
 
-            # loop through the input data to make sure no rows contain zero or
-            # null values
+            # look for rows which contain zero or null values, we only need
+            # the values of the field (no geometries) and can stop at the
+            # first match; the worker reads the values again together with the
+            # geometries
+            request = QgsFeatureRequest()
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+            request.setSubsetOfAttributes([layer.fieldNameIndex(field)])
+
             zero_null = None
-            for feature in layer.getFeatures():
+            for feature in layer.getFeatures(request):
                 feature_value = feature.attribute(field)
                 if type(feature_value) is QPyNullVariant or feature_value == 0:
                     zero_null = 1
+                    break
 
             # ask the user if she wants to continue if one or more zero or null
             # rows are found in the input data
@@ -307,28 +487,53 @@ class Cartogram:
 
         return count
 
-    def create_memory_layer(self, layer, inputField):
-        """Create an in-memory copy of an existing vector layer."""
+    def create_memory_layer(self, layer, inputField, copy_features=True):
+        """Create an in-memory copy of an existing vector layer.
+
+        Without copy_features, the new layer is empty and only has an id field
+        and the input field.
+        """
 
         data_provider = layer.dataProvider()
 
-        # create the layer path defining geometry type and reference system
+        # create the layer path defining geometry type and reference system;
+        # the spatial index is only created by the worker once the final
+        # geometries have been written, keeping it up to date while the
+        # geometries change would be a waste of time
         geometry_type = QGis.vectorGeometryType(layer.geometryType())
         crs_id = layer.crs().authid()
-        path = geometry_type + '?crs=' + crs_id + '&index=yes'
+        path = geometry_type + '?crs=' + crs_id
 
         # create the memory layer and get a reference to the data provider
         memory_layer = QgsVectorLayer(path, 'cartogram_{}'.format(inputField), 'memory')
         memory_layer_data_provider = memory_layer.dataProvider()
 
-        # copy all attributes from the source layer to the memory layer
+        if copy_features:
+            fields = layer.fields().toList()
+        else:
+            fields = [QgsField('source_id', QVariant.Int),
+                layer.fields()[layer.fieldNameIndex(inputField)]]
+
+        # copy the attributes from the source layer to the memory layer
         memory_layer.startEditing()
-        memory_layer_data_provider.addAttributes(
-            layer.fields().toList())
+        memory_layer_data_provider.addAttributes(fields)
         memory_layer.commitChanges()
 
-        # copy all features from the source layer to the memory layer
+        if not copy_features:
+            return memory_layer
+
+        # copy all features from the source layer to the memory layer, adding
+        # them in large batches keeps the provider overhead down
+        features = []
         for feature in layer.getFeatures():
-            memory_layer_data_provider.addFeatures([feature])
+            features.append(feature)
+            if len(features) >= COPY_BATCH_SIZE:
+                memory_layer_data_provider.addFeatures(features)
+                features = []
+
+        if features:
+            memory_layer_data_provider.addFeatures(features)
+
+        memory_layer.updateExtents()
 
         return memory_layer
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+"""Pool of processes which create the frames of an animation in parallel."""
+
+from cartogram_coordinates import CoordinateBuffer
+from cartogram_core import CartogramSolver
+from cartogram_kernel import set_threads
+from cartogram_pool import ProcessPool
+
+
+# topology (vertex index and offset arrays) of the source layer, which is the
+# same for all frames and set up once by initialize() when a process starts
+topology = None
+
+
+def initialize(spec):
+    """Keep the topology of the source layer when a worker process starts."""
+    global topology
+    topology = spec
+
+    # the frames are already created in parallel to each other
+    set_threads(1)
+
+
+def solve(task):
+    """Create the cartogram of a single frame in its own coordinate buffer.
+
+    Returns the index of the frame and the error curve of the solver.
+    """
+
+    (frame, path, values, iterations, options) = task
+
+    coordinates = CoordinateBuffer(path, *topology)
+    solver = CartogramSolver(coordinates, values, iterations, processes=1,
+        **options)
+    solver.run()
+    coordinates.flush()
+
+    return (frame, solver.error_curve)
+
+
+class FramePool(ProcessPool):
+    """Worker processes which each create one frame at a time.
+
+    Frames are independent of each other, so a frame is the unit of work: the
+    processes receive the topology of the source layer once, and for each
+    frame only the path of its coordinate buffer and its values. At most
+    processes frames are created at the same time.
+    """
+
+    def __init__(self, coordinates, processes=None):
+        """Constructor."""
+
+        ProcessPool.__init__(self, processes, initialize,
+            (coordinates.spec()[1:],))
+
+    def solve(self, frames, iterations, options, cancelled=None):
+        """Create all frames, yielding (frame, error_curve) as they finish.
+
+        frames is a list of (coordinates, values) pairs, options are passed
+        on to CartogramSolver. Every frame is tracked until its result
+        arrives: a worker process which exits unexpectedly raises a
+        RuntimeError, and as soon as cancelled() returns True no further
+        results are yielded, without waiting for the frames being created;
+        the pool should then be terminated.
+        """
+
+        # hand out one frame per process at a time, so that no process sits
+        # idle while others still have a queue of frames
+        return self.run(solve, [(frame, coordinates.path, values, iterations,
+            options) for (frame, (coordinates, values)) in enumerate(frames)],
+            self.processes, cancelled)
@@ -0,0 +1,288 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Benchmark the cartogram engine on synthetic polygon grids, without QGIS.
+
+Usage: python cartogram_benchmark.py --sizes 100 1000 10000 --output bench.json
+
+Every combination of grid size, vertices per edge, value skew and force
+kernel backend is run once. The wall clock and CPU time taken by each stage
+is written as JSON, so results can be compared between releases. The force
+kernel is checked against the per-point reference formula on a sample of the
+vertices, and the exit code is 1 if it deviates by more than
+cartogram_engine.TOLERANCE.
+"""
+
+from cartogram_coordinates import CoordinateBuffer
+from cartogram_core import CartogramSolver, prepare_values, reduction_factor
+from cartogram_engine import (TOLERANCE, available_backends, default_backend,
+    max_deviation)
+from cartogram_stats import Stopwatch
+
+import cartogram_geojson
+
+import argparse
+import datetime
+import json
+import math
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+
+import numpy
+
+# distance between the center and the corners of a grid cell
+CELL_SIZE = 1000.0
+
+# corners and edge vertices are rounded to this many decimals, so that cells
+# computing the same point from different centers agree exactly
+DECIMALS = 6
+
+# number of vertices compared against the (slow) per-point reference formula
+REFERENCE_SAMPLE = 100
+
+
+def hexagon_grid(count, edge_vertices=1, jitter=0, seed=0):
+    """Create a tessellation of count hexagonal cells.
+
+    Each edge is split into edge_vertices segments, so every ring has
+    6 * edge_vertices + 1 vertices. With a jitter greater than zero, the
+    corners are moved randomly by up to that fraction of the cell size,
+    which turns the regular grid into irregular cells that still share their
+    borders. Returns a list of single part multipolygons.
+    """
+
+    random = numpy.random.RandomState(seed)
+
+    columns = int(math.ceil(math.sqrt(count)))
+    index = numpy.arange(count)
+    row = index // columns
+    column = index % columns
+
+    center_x = (column + 0.5 * (row % 2)) * math.sqrt(3) * CELL_SIZE
+    center_y = row * 1.5 * CELL_SIZE
+
+    angles = numpy.radians(30 + 60 * numpy.arange(6))
+    corners = numpy.empty((count, 6, 2), numpy.float64)
+    corners[:, :, 0] = center_x[:, numpy.newaxis] + CELL_SIZE * numpy.cos(
+        angles)
+    corners[:, :, 1] = center_y[:, numpy.newaxis] + CELL_SIZE * numpy.sin(
+        angles)
+    corners = numpy.round(corners, DECIMALS)
+
+    if jitter > 0:
+        # move every distinct corner once, so that neighbours stay connected
+        (unique, inverse) = numpy.unique(corners.reshape(-1, 2),
+            return_inverse=True, axis=0)
+        unique += random.uniform(-jitter, jitter, unique.shape) * CELL_SIZE
+        corners = numpy.round(unique[inverse.ravel()], DECIMALS).reshape(
+            corners.shape)
+
+    # split the edges, and close the rings with their first corner
+    following = numpy.roll(corners, -1, axis=1)
+    steps = numpy.arange(edge_vertices) / float(edge_vertices)
+    edges = corners[:, :, numpy.newaxis, :] + steps[:, numpy.newaxis] * (
+        following - corners)[:, :, numpy.newaxis, :]
+    rings = numpy.round(edges.reshape(count, -1, 2), DECIMALS)
+    rings = numpy.concatenate((rings, rings[:, :1]), axis=1)
+
+    return [[[ring]] for ring in rings]
+
+
+def skewed_values(count, skew, seed=0):
+    """Draw log-normal values, a skew of zero makes them all equal."""
+    random = numpy.random.RandomState(seed)
+    return random.lognormal(0, skew, count) * 1000
+
+
+def benchmark(count, edge_vertices, skew, iterations, jitter=0, theta=0,
+    tolerance=0, processes=None, seed=0, backend=None, coarse_vertices=0,
+    grid_size=0):
+    """Create one cartogram and return the timings of its stages."""
+
+    stopwatch = Stopwatch()
+    processes = processes or multiprocessing.cpu_count()
+    backend = backend or default_backend()
+
+    with stopwatch.measure('generate'):
+        features = hexagon_grid(count, edge_vertices, jitter, seed)
+    raw_values = skewed_values(count, skew, seed)
+
+    with stopwatch.measure('load_values'):
+        (values, min_value) = prepare_values(raw_values)
+    with stopwatch.measure('topology'):
+        coordinates = CoordinateBuffer.create(features)
+
+    # the solver reports the timings of the stages of every iteration
+    details = []
+    solver = CartogramSolver(coordinates, values, iterations, theta=theta,
+        tolerance=tolerance, processes=processes, backend=backend,
+        coarse_vertices=coarse_vertices, grid_size=grid_size,
+        statistics=details.append)
+    with stopwatch.measure('solve'):
+        solver.run()
+
+    for record in details:
+        for (stage, times) in record['stages'].items():
+            totals = stopwatch.stages.setdefault(stage,
+                {'wall': 0.0, 'cpu': 0.0})
+            totals['wall'] += times['wall']
+            totals['cpu'] += times['cpu']
+
+    (mean_error, max_error) = solver.error_curve[-1]
+
+    # the force kernel has to agree with the per-point formula on the final
+    # geometries
+    (features, force_reduction_factor) = reduction_factor(coordinates,
+        values)[:2]
+    with stopwatch.measure('reference'):
+        deviation = max_deviation(coordinates.vertices, features,
+            force_reduction_factor, REFERENCE_SAMPLE, backend=backend)
+
+    # the nested coordinate lists the geometries are built from; without
+    # QGIS, no data provider is written to
+    with stopwatch.measure('polygons'):
+        [coordinates.polygons(index)
+            for index in range(coordinates.feature_count())]
+
+    collection = {'type': 'FeatureCollection', 'features': [{'type':
+        'Feature', 'properties': {'value': float(value)}, 'geometry': None}
+        for value in raw_values]}
+    (handle, path) = tempfile.mkstemp(suffix='.geojson')
+    os.close(handle)
+    try:
+        with stopwatch.measure('export'):
+            cartogram_geojson.write(path, collection, coordinates)
+    finally:
+        os.remove(path)
+
+    result = {
+        'polygons': count,
+        'edge_vertices': edge_vertices,
+        'skew': skew,
+        'jitter': jitter,
+        'iterations': iterations,
+        'theta': theta,
+        'tolerance': tolerance,
+        'processes': processes,
+        'backend': backend,
+        'coarse_vertices': coarse_vertices,
+        'grid_size': grid_size,
+        'vertices': coordinates.ring_vertex_count(),
+        'unique_vertices': coordinates.vertex_count(),
+        'mean_error': mean_error,
+        'max_error': max_error,
+        'kernel_deviation': deviation,
+        'stages': stopwatch.stages,
+        'vertex_throughput': sum(record['vertices'] for record in details) /
+            max(stopwatch.stages.get('transform', {}).get('wall', 0), 1e-9),
+        'details': details,
+    }
+
+    coordinates.close()
+
+    return result
+
+
+def environment():
+    """Describe the machine and the software the benchmark runs on."""
+    return {
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'platform': platform.platform(),
+        'cpu_count': multiprocessing.cpu_count(),
+    }
+
+
+def parse_arguments(argv=None):
+    """Parse the command line."""
+
+    parser = argparse.ArgumentParser(description=u'Benchmark the cartogram '
+        u'engine on synthetic hexagon grids.')
+    parser.add_argument('--sizes', type=int, nargs='+',
+        default=[100, 1000, 10000], help=u'numbers of polygons, default 100 '
+            u'1000 10000')
+    parser.add_argument('--edge-vertices', type=int, nargs='+', default=[1],
+        help=u'numbers of segments per cell edge, default 1')
+    parser.add_argument('--skews', type=float, nargs='+', default=[1.0],
+        help=u'spreads of the log-normal values, default 1')
+    parser.add_argument('--jitter', type=float, default=0.2,
+        help=u'random displacement of the corners relative to the cell '
+            u'size, default 0.2')
+    parser.add_argument('-i', '--iterations', type=int, default=3,
+        help=u'number of iterations, default 3')
+    parser.add_argument('--theta', type=float, default=0,
+        help=u'Barnes-Hut approximation, default 0 (exact)')
+    parser.add_argument('--tolerance', type=float, default=0,
+        help=u'influence culling tolerance in metres, default 0 (exact)')
+    parser.add_argument('--backends', nargs='+',
+        choices=available_backends(), default=[default_backend()],
+        help=u'force kernels to compare, default {}'.format(
+            default_backend()))
+    parser.add_argument('--grid-size', type=float, default=0,
+        help=u'cell size of the displacement grid relative to the cell size '
+            u'of the polygons, default 0 (exact)')
+    parser.add_argument('--coarse-vertices', type=int, default=0,
+        help=u'run all but the last iterations on rings simplified to about '
+            u'this many vertices, default 0 (off)')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+        help=u'number of worker processes, default one per CPU')
+    parser.add_argument('--seed', type=int, default=0,
+        help=u'seed of the random geometries and values')
+    parser.add_argument('-o', '--output',
+        help=u'file to write the JSON results to, default standard output')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Run the benchmarks, return the exit code."""
+
+    arguments = parse_arguments(argv)
+
+    results = []
+    for count in arguments.sizes:
+        for edge_vertices in arguments.edge_vertices:
+            for skew in arguments.skews:
+                for backend in arguments.backends:
+                    result = benchmark(count, edge_vertices, skew,
+                        arguments.iterations, arguments.jitter,
+                        arguments.theta, arguments.tolerance,
+                        arguments.processes, arguments.seed, backend,
+                        arguments.coarse_vertices,
+                        arguments.grid_size * CELL_SIZE)
+                    results.append(result)
+
+                    sys.stderr.write(u'{} polygons, {} vertices, skew {}, '
+                        u'{}: {}\n'.format(count, result['vertices'], skew,
+                            backend, u', '.join(u'{} {:.3f}s'.format(stage,
+                                times['wall']) for (stage, times)
+                                in sorted(result['stages'].items()))))
+
+    report = dict(environment(), results=results)
+
+    # a kernel which deviates from the reference formula fails the benchmark
+    exit_code = 0
+    for result in results:
+        if result['kernel_deviation'] > TOLERANCE:
+            sys.stderr.write(u'{} polygons, {}: the force kernel deviates by '
+                u'{:.3g} from the reference formula\n'.format(
+                    result['polygons'], result['backend'],
+                    result['kernel_deviation']))
+            exit_code = 1
+
+    if arguments.output:
+        with open(arguments.output, 'w') as target:
+            json.dump(report, target, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+"""On-disk cache of cartogram results, addressed by the content of a job."""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+
+try:
+    from ConfigParser import Error as ConfigError, RawConfigParser
+except ImportError:
+    from configparser import Error as ConfigError, RawConfigParser
+
+import numpy
+
+# default upper limit of the size of the cache directory
+CACHE_SIZE = 1 << 30
+
+# number of array items which are hashed at a time
+HASH_CHUNK_SIZE = 1 << 20
+
+CHECKPOINT = re.compile(r'^(\d+)\.npz$')
+
+
+def plugin_version():
+    """Return the version of the plugin from its metadata.txt."""
+
+    metadata = RawConfigParser()
+    try:
+        metadata.read(os.path.join(os.path.dirname(os.path.abspath(
+            __file__)), 'metadata.txt'))
+        return metadata.get('general', 'version')
+    except ConfigError:
+        return ''
+
+
+class ResultCache(object):
+    """Checkpoints of cartogram runs, stored after every iteration.
+
+    An entry is a directory named after the hash of everything which
+    determines the result of a job: the topology and vertices of the
+    geometries, the values, the options of the algorithm and the version of
+    the plugin. The number of iterations is not part of the key; every entry
+    holds a checkpoint per iteration instead, so a run can continue from the
+    latest checkpoint of a shorter one, or of a run which was cancelled or
+    crashed. A checkpoint holds the vertex array of the coordinate buffer and
+    the size errors before each of the iterations so far.
+
+    Whenever the cache grows beyond max_size bytes, the least recently used
+    entries are removed. The version defaults to the one in the plugin's
+    metadata.txt.
+
+    Several processes may share a cache, e.g. the frames of an animation
+    created in parallel. Entries used since the cache was created may
+    belong to one of them and are never removed, so the cache can exceed
+    max_size until a later job cleans it up.
+    """
+
+    def __init__(self, directory, max_size=CACHE_SIZE, version=None):
+        """Constructor."""
+
+        self.directory = directory
+        self.max_size = max_size
+        self.version = plugin_version() if version is None else version
+        self.created = time.time()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, coordinates, values, options):
+        """Hash the input of a job into the key of its cache entry."""
+
+        digest = hashlib.sha1()
+        for array in (coordinates.vertices, coordinates.vertex_index,
+            coordinates.ring_offsets, coordinates.part_offsets,
+            coordinates.feature_offsets, numpy.asarray(values, numpy.float64)):
+            if array is None:
+                digest.update(b'-')
+                continue
+
+            # hash large (memory-mapped) arrays a chunk at a time, so that
+            # they are never copied into memory as a whole
+            for start in range(0, len(array), HASH_CHUNK_SIZE):
+                digest.update(numpy.ascontiguousarray(
+                    array[start:start + HASH_CHUNK_SIZE]).tobytes())
+
+        digest.update(json.dumps([self.version, sorted(options.items())]
+            ).encode('utf-8'))
+
+        return digest.hexdigest()
+
+    def path(self, key, iteration=None):
+        """Return the directory of an entry, or the file of a checkpoint."""
+
+        path = os.path.join(self.directory, key)
+        if iteration is None:
+            return path
+
+        return os.path.join(path, '{}.npz'.format(iteration))
+
+    def checkpoints(self, key):
+        """Return the iterations for which an entry holds a checkpoint."""
+
+        path = self.path(key)
+        if not os.path.isdir(path):
+            return []
+
+        return sorted(int(match.group(1)) for match in
+            (CHECKPOINT.match(name) for name in os.listdir(path)) if match)
+
+    def load(self, key, coordinates, iterations):
+        """Restore the latest checkpoint of at most the given iterations.
+
+        The vertices of the coordinate buffer are replaced by those of the
+        checkpoint. Returns the number of iterations the restored vertices
+        have been through, zero if there is no suitable checkpoint, and the
+        error curve up to that iteration.
+        """
+
+        # marking the entry as used first keeps other processes from
+        # evicting it while it is read
+        checkpoints = self.checkpoints(key)
+        if checkpoints:
+            self.touch(key)
+
+        for iteration in reversed(checkpoints):
+            if iteration > iterations:
+                continue
+
+            try:
+                with numpy.load(self.path(key, iteration)) as checkpoint:
+                    vertices = checkpoint['vertices']
+                    error_curve = [tuple(errors)
+                        for errors in checkpoint['error_curve']]
+            except (IOError, KeyError, ValueError):
+                # an incomplete or corrupt file, try the previous one
+                continue
+
+            if vertices.shape != coordinates.vertices.shape:
+                continue
+
+            coordinates.vertices[:] = vertices
+            coordinates.flush()
+
+            return (iteration, error_curve)
+
+        return (0, [])
+
+    def store(self, key, iteration, coordinates, error_curve=()):
+        """Store the vertices of a coordinate buffer after an iteration.
+
+        error_curve holds the mean and max size error before each iteration.
+        Nothing is stored if the checkpoint alone would exceed max_size.
+        """
+
+        if coordinates.vertices.nbytes + 16 * len(error_curve) > \
+            self.max_size:
+            return
+
+        path = self.path(key)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        # write to a temporary file first, so that readers never see a
+        # partially written checkpoint
+        (handle, temporary) = tempfile.mkstemp(suffix='.tmp', dir=path)
+        with os.fdopen(handle, 'wb') as target:
+            numpy.savez(target, vertices=numpy.asarray(coordinates.vertices),
+                error_curve=numpy.array(error_curve,
+                    numpy.float64).reshape(-1, 2))
+        os.rename(temporary, self.path(key, iteration))
+
+        self.touch(key)
+        self.evict(key)
+
+    def touch(self, key):
+        """Mark an entry as recently used."""
+
+        try:
+            os.utime(self.path(key), None)
+        except OSError:
+            # removed by another process meanwhile
+            pass
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries beyond the size limit.
+
+        The entry keep, which is being written, is never removed; if it alone
+        exceeds the limit, its older checkpoints are removed instead. Nor are
+        entries which have been used since the cache was created, as another
+        process of the same job may be using them.
+        """
+
+        entries = []
+        total = 0
+        for key in os.listdir(self.directory):
+            path = self.path(key)
+            try:
+                size = sum(os.path.getsize(os.path.join(path, name))
+                    for name in os.listdir(path))
+                entries.append((os.path.getmtime(path), size, path))
+            except OSError:
+                # not an entry, or removed by another process meanwhile
+                continue
+            total += size
+
+        kept = None if keep is None else self.path(keep)
+        for (mtime, size, path) in sorted(entries):
+            if total <= self.max_size:
+                break
+            if path == kept or mtime >= self.created:
+                continue
+
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+        if keep is not None and total > self.max_size:
+            for iteration in self.checkpoints(keep)[:-1]:
+                if total <= self.max_size:
+                    break
+
+                path = self.path(keep, iteration)
+                try:
+                    size = os.path.getsize(path)
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
@@ -0,0 +1,173 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Create a cartogram from a GeoJSON file, without QGIS.
+
+Usage: python cartogram_cli.py input.geojson output.geojson --field VALUE
+
+Distances (tolerance, grid size and snap) are given in the units of the
+coordinates of the input file. A displacement grid saved with --grid-output
+transforms other files the same way:
+
+    python cartogram_cli.py other.geojson output.geojson --apply-grid grid.npz
+"""
+
+from cartogram_cache import ResultCache
+from cartogram_coordinates import CoordinateBuffer
+from cartogram_core import REFINE_ITERATIONS, CartogramSolver, prepare_values
+from cartogram_engine import BACKENDS
+from cartogram_grid import DisplacementGrid
+from cartogram_stats import JsonLog
+
+import cartogram_geojson
+
+import argparse
+import sys
+
+
+def parse_arguments(argv=None):
+    """Parse the command line."""
+
+    parser = argparse.ArgumentParser(description=u'Create a cartogram from '
+        u'the polygons of a GeoJSON file.')
+    parser.add_argument('input', help=u'GeoJSON file to read')
+    parser.add_argument('output', help=u'GeoJSON file to write')
+    parser.add_argument('-f', '--field',
+        help=u'property holding the value of each feature')
+    parser.add_argument('-i', '--iterations', type=int, default=5,
+        help=u'(maximum) number of iterations, default 5')
+    parser.add_argument('--target-mean-error', type=float, default=0,
+        help=u'stop once the mean size error (in percent) is below this')
+    parser.add_argument('--target-max-error', type=float, default=0,
+        help=u'stop once the max size error (in percent) is below this')
+    parser.add_argument('--theta', type=float, default=0,
+        help=u'approximate the force field with a Barnes-Hut quadtree')
+    parser.add_argument('--tolerance', type=float, default=0,
+        help=u'evaluate features which move a vertex less than this only '
+            u'coarsely')
+    parser.add_argument('--grid-size', type=float, default=0,
+        help=u'evaluate the forces on a grid with cells of this size and '
+            u'interpolate them at the vertices')
+    parser.add_argument('--grid-output', metavar='FILE',
+        help=u'save the total displacement, sampled on the grid, to this '
+            u'file')
+    parser.add_argument('--apply-grid', metavar='FILE',
+        help=u'transform the input with a saved displacement grid instead of '
+            u'creating a cartogram')
+    parser.add_argument('--coarse-vertices', type=int, default=0,
+        help=u'run all but the last iterations on rings simplified to about '
+            u'this many vertices')
+    parser.add_argument('--refine-iterations', type=int,
+        default=REFINE_ITERATIONS, help=u'number of iterations on all '
+            u'vertices after the coarse ones, default {}'.format(
+                REFINE_ITERATIONS))
+    parser.add_argument('--snap', type=float, default=0,
+        help=u'merge vertices which round to the same node of a grid with '
+        u'this spacing')
+    parser.add_argument('--precision', type=int, default=None,
+        help=u'number of decimals of the output coordinates')
+    parser.add_argument('--cache', metavar='DIRECTORY',
+        help=u'cache the result of every iteration in this directory and '
+            u'continue from the latest cached iteration of the same job')
+    parser.add_argument('--checkpoint-interval', type=int, default=1,
+        help=u'store a checkpoint in the cache every this many iterations, '
+            u'0 turns checkpoints off, default 1')
+    parser.add_argument('--cache-size', type=float, default=1024,
+        help=u'maximum size of the cache in megabytes, default 1024')
+    parser.add_argument('--log', metavar='FILE',
+        help=u'append the timings of every iteration to this file as JSON '
+            u'lines')
+    parser.add_argument('--profile', metavar='FILE',
+        help=u'profile one iteration and write the statistics to this file')
+    parser.add_argument('--profile-iteration', type=int, default=1,
+        help=u'the iteration to profile, default 1')
+    parser.add_argument('--backend', choices=BACKENDS, default=None,
+        help=u'implementation of the force kernel, default numba if it is '
+            u'installed, numpy otherwise')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+        help=u'number of worker processes, default one per CPU')
+    parser.add_argument('-q', '--quiet', action='store_true',
+        help=u'do not print any progress messages')
+
+    arguments = parser.parse_args(argv)
+
+    if arguments.field is None and arguments.apply_grid is None:
+        parser.error(u'argument -f/--field is required')
+    if arguments.checkpoint_interval < 0:
+        parser.error(u'argument --checkpoint-interval must not be negative')
+    if arguments.grid_output and arguments.grid_size <= 0:
+        parser.error(u'argument --grid-output needs --grid-size')
+
+    return arguments
+
+
+def main(argv=None):
+    """Run the command line interface, return the exit code."""
+
+    arguments = parse_arguments(argv)
+
+    def feedback(message):
+        if not arguments.quiet:
+            sys.stderr.write(u'{}\n'.format(message))
+
+    coordinates = None
+    try:
+        feedback(u'reading features')
+        collection = cartogram_geojson.read(arguments.input)
+        features = collection['features']
+
+        coordinates = CoordinateBuffer.create((cartogram_geojson.polygons(
+            feature.get('geometry')) for feature in features), arguments.snap)
+
+        if arguments.apply_grid:
+            feedback(u'applying the displacement grid')
+            grid = DisplacementGrid.load(arguments.apply_grid)
+            coordinates.vertices[:] = grid.transform(coordinates.vertices)
+
+            feedback(u'writing features')
+            cartogram_geojson.write(arguments.output, collection,
+                coordinates, arguments.precision)
+            return 0
+
+        (values, min_value) = prepare_values(cartogram_geojson.value(feature,
+            arguments.field) for feature in features)
+
+        shared = coordinates.ring_vertex_count() - coordinates.vertex_count()
+        feedback(u'{} vertices, {} of them shared between rings'.format(
+            coordinates.ring_vertex_count(), shared))
+
+        cache = None
+        if arguments.cache:
+            cache = ResultCache(arguments.cache,
+                int(arguments.cache_size * (1 << 20)))
+
+        solver = CartogramSolver(coordinates, values, arguments.iterations,
+            theta=arguments.theta, tolerance=arguments.tolerance,
+            target_mean_error=arguments.target_mean_error,
+            target_max_error=arguments.target_max_error,
+            processes=arguments.processes, cache=cache,
+            checkpoint_interval=arguments.checkpoint_interval,
+            profile_iteration=arguments.profile_iteration,
+            profile_path=arguments.profile, backend=arguments.backend,
+            coarse_vertices=arguments.coarse_vertices,
+            refine_iterations=arguments.refine_iterations,
+            grid_size=arguments.grid_size, grid_path=arguments.grid_output,
+            feedback=feedback,
+            statistics=JsonLog(arguments.log).write if arguments.log else None)
+        solver.run()
+
+        feedback(u'writing features')
+        cartogram_geojson.write(arguments.output, collection, coordinates,
+            arguments.precision)
+    except (IOError, ValueError) as e:
+        sys.stderr.write(u'error: {}\n'.format(e))
+        return 1
+    finally:
+        if coordinates is not None:
+            coordinates.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,577 @@
+# -*- coding: utf-8 -*-
+
+"""Shared, memory-mapped storage for the vertices of a polygon layer."""
+
+import os
+import tempfile
+
+import numpy
+
+from cartogram_engine import flatten_rings
+
+# number of vertices which are converted and written, or measured, at a time
+CHUNK_SIZE = 1 << 20
+
+
+def offsets_from_counts(counts):
+    """Turn a list of item counts into an offset array starting at zero."""
+    offsets = numpy.zeros(len(counts) + 1, numpy.int64)
+    offsets[1:] = numpy.cumsum(counts)
+    return offsets
+
+
+def deduplicate(coords, snap=0):
+    """Merge vertices which are shared between rings.
+
+    With a snap spacing greater than zero, vertices which round to the same
+    node of a grid with that spacing are merged as well. Returns the unique
+    vertices, numbered in the order in which they first appear, the index of
+    every vertex in the unique array and the (sorted) position at which each
+    unique vertex first appears.
+    """
+
+    if snap > 0:
+        keys = numpy.round(coords / snap)
+    else:
+        # adding zero turns -0.0 into 0.0, which would otherwise be considered
+        # different when comparing the raw bytes
+        keys = coords + 0.0
+
+    (_, first, inverse) = numpy.unique(keys, return_index=True,
+        return_inverse=True, axis=0)
+
+    order = numpy.argsort(first)
+    rank = numpy.empty_like(order)
+    rank[order] = numpy.arange(len(order))
+
+    return (coords[first[order]], rank[inverse.ravel()], first[order])
+
+
+def significance(coords, fixed):
+    """Rank the vertices of a line by Douglas-Peucker simplification.
+
+    coords is an (N, 2) array and fixed a sorted array of the positions which
+    are always kept, including the first and last one; the line is
+    simplified between each pair of consecutive fixed positions. Returns
+    the distance at which each vertex stops being dropped: keeping all
+    vertices with a significance of at least some distance gives the
+    Douglas-Peucker simplification with that tolerance. Fixed vertices have
+    an infinite significance.
+    """
+
+    result = numpy.zeros(len(coords), numpy.float64)
+    result[fixed] = numpy.inf
+
+    # all arcs are split at once, one level of the recursion at a time
+    starts = fixed[:-1]
+    ends = fixed[1:]
+    bounds = numpy.full(len(starts), numpy.inf)
+    while True:
+        inner = ends - starts - 1
+        (starts, ends, bounds, inner) = (starts[inner > 0], ends[inner > 0],
+            bounds[inner > 0], inner[inner > 0])
+        if len(starts) == 0:
+            return result
+
+        offsets = offsets_from_counts(inner)
+        arc = numpy.repeat(numpy.arange(len(starts)), inner)
+        position = starts[arc] + numpy.arange(offsets[-1]) - offsets[arc] + 1
+
+        # distance of every inner vertex from the chord of its arc, or from
+        # the start of a closed arc
+        start = coords[starts][arc]
+        chord = coords[ends][arc] - start
+        offset = coords[position] - start
+        length = numpy.hypot(chord[:, 0], chord[:, 1])
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            distance = numpy.where(length > 0, numpy.abs(chord[:, 0] *
+                offset[:, 1] - chord[:, 1] * offset[:, 0]) / length,
+                numpy.hypot(offset[:, 0], offset[:, 1]))
+
+        # the first vertex farthest from the chord splits each arc; it is
+        # never more significant than the vertex which split its parent arc
+        farthest = numpy.maximum.reduceat(distance, offsets[:-1])
+        candidates = numpy.flatnonzero(distance == farthest[arc])
+        split = position[candidates[numpy.unique(arc[candidates],
+            return_index=True)[1]]]
+        level = numpy.minimum(farthest, bounds)
+        result[split] = level
+
+        (starts, ends, bounds) = (numpy.concatenate((starts, split)),
+            numpy.concatenate((split, ends)),
+            numpy.concatenate((level, level)))
+
+
+class CoordinateBuffer(object):
+    """Flat vertex storage shared between the worker processes.
+
+    Neighbouring polygons share their boundary vertices, so each distinct
+    vertex is stored only once in a (U, 2) float64 array backed by a temporary
+    file. Worker processes map the same memory and update disjoint slices of
+    it in place, which moves each shared vertex exactly once and keeps
+    adjacent polygons free of gaps and overlaps. The rings refer to the
+    unique vertices through vertex_index, and offset arrays describe how they
+    make up the geometries:
+
+    - ring i consists of vertices[vertex_index[ring_offsets[i]:
+      ring_offsets[i + 1]]],
+    - part j consists of rings part_offsets[j] to part_offsets[j + 1] - 1,
+      the first of which is the exterior ring,
+    - feature k consists of parts feature_offsets[k] to
+      feature_offsets[k + 1] - 1.
+
+    Because the unique vertices are numbered in order of first appearance,
+    the vertices introduced by ring i are the contiguous range
+    segment_offsets[i]:segment_offsets[i + 1].
+
+    For layers too large to merge the shared vertices in memory, vertex_index
+    may be None: every ring then stores its own copy of its vertices, ring i
+    is vertices[ring_offsets[i]:ring_offsets[i + 1]] and segment_offsets
+    equals ring_offsets.
+    """
+
+    def __init__(self, path, vertex_index, ring_offsets, part_offsets,
+        feature_offsets, segment_offsets, mode='r+'):
+        """Constructor."""
+
+        self.path = path
+        self.vertex_index = vertex_index
+        self.ring_offsets = ring_offsets
+        self.part_offsets = part_offsets
+        self.feature_offsets = feature_offsets
+        self.segment_offsets = segment_offsets
+
+        vertex_count = int(segment_offsets[-1])
+        if vertex_count > 0:
+            self.vertices = numpy.memmap(path, numpy.float64, mode,
+                shape=(vertex_count, 2))
+        else:
+            # an empty file cannot be mapped
+            self.vertices = numpy.zeros((0, 2), numpy.float64)
+
+    @classmethod
+    def create(cls, features, snap=0, directory=None, shared=True):
+        """Create a new buffer from an iterable of multipolygons.
+
+        Each multipolygon is a list of polygons, each polygon a list of rings
+        and each ring a sequence of (x, y) pairs. Empty rings and parts are
+        dropped. Vertices which round to the same node of a grid with a
+        spacing of snap are merged.
+
+        The features are consumed one at a time and their vertices written
+        to the backing file in chunks. Merging the shared vertices needs all
+        of them in memory at once; without shared, every ring keeps its own
+        vertices, vertex_index is None and memory use only grows with the
+        number of rings.
+        """
+
+        ring_counts = []
+        part_counts = []
+        vertex_counts = []
+
+        (handle, path) = tempfile.mkstemp(suffix='.cartogram', dir=directory)
+        with os.fdopen(handle, 'wb') as target:
+            rings = []
+            pending = 0
+            for polygons in features:
+                polygons = [[ring for ring in polygon if len(ring) > 0]
+                    for polygon in polygons]
+                polygons = [polygon for polygon in polygons
+                    if len(polygon) > 0]
+
+                part_counts.append(len(polygons))
+                for polygon in polygons:
+                    ring_counts.append(len(polygon))
+                    for ring in polygon:
+                        rings.append(ring)
+                        vertex_counts.append(len(ring))
+                        pending += len(ring)
+
+                if pending >= CHUNK_SIZE:
+                    target.write(flatten_rings(rings)[0].tobytes())
+                    rings = []
+                    pending = 0
+
+            target.write(flatten_rings(rings)[0].tobytes())
+
+        ring_offsets = offsets_from_counts(vertex_counts)
+        part_offsets = offsets_from_counts(ring_counts)
+        feature_offsets = offsets_from_counts(part_counts)
+
+        if not shared:
+            return cls(path, None, ring_offsets, part_offsets,
+                feature_offsets, ring_offsets)
+
+        coords = cls(path, None, ring_offsets, part_offsets, feature_offsets,
+            ring_offsets).vertices
+        if len(coords) > 0:
+            (vertices, vertex_index, first) = deduplicate(
+                numpy.array(coords), snap)
+        else:
+            vertices = coords
+            vertex_index = first = numpy.zeros(0, numpy.int64)
+        del coords
+
+        # the number of unique vertices which appeared before each ring
+        segment_offsets = numpy.searchsorted(first, ring_offsets)
+
+        # the unique vertices replace the raw ones in the backing file
+        with open(path, 'r+b') as target:
+            target.truncate(vertices.nbytes)
+
+        coordinates = cls(path, vertex_index, ring_offsets, part_offsets,
+            feature_offsets, segment_offsets)
+        coordinates.vertices[:] = vertices
+        coordinates.flush()
+
+        return coordinates
+
+    def copy(self, directory=None):
+        """Create a new buffer with the same topology and a copy of the
+        vertices."""
+
+        (handle, path) = tempfile.mkstemp(suffix='.cartogram', dir=directory)
+        os.close(handle)
+
+        coordinates = CoordinateBuffer(path, self.vertex_index,
+            self.ring_offsets, self.part_offsets, self.feature_offsets,
+            self.segment_offsets, 'w+')
+        coordinates.vertices[:] = self.vertices
+        coordinates.flush()
+
+        return coordinates
+
+    def simplify(self, vertex_count, directory=None):
+        """Create a coarse copy of the buffer with about vertex_count vertices.
+
+        The first, last and two intermediate vertices of every ring are
+        kept, as well as all vertices at which the rings sharing a border
+        change, i.e. the ends of shared borders and the junctions of three or
+        more rings. The arcs in between are simplified by Douglas-Peucker,
+        keeping the most significant vertices up to about vertex_count in
+        total, so narrow features keep their outline. A shared vertex is
+        kept or dropped in all of its rings alike, so neighbouring polygons
+        stay free of gaps and overlaps. Like Douglas-Peucker itself, this
+        does not rule out that a coarse ring crosses itself or a neighbour
+        where two arcs run very close to each other. Returns the new buffer
+        and a boolean mask of the unique vertices it keeps.
+        """
+
+        unique_count = self.vertex_count()
+        ring_starts = self.ring_offsets[:-1]
+        ring_ends = self.ring_offsets[1:] - 1
+        ring_counts = numpy.diff(self.ring_offsets)
+        index = self.vertex_index
+        if index is None:
+            index = numpy.arange(self.ring_vertex_count())
+
+        fixed = numpy.zeros(len(index), bool)
+        for position in (ring_starts, ring_starts + ring_counts // 3,
+            ring_starts + 2 * ring_counts // 3, ring_ends):
+            fixed[position] = True
+
+        # the number of rings each vertex belongs to, without counting the
+        # closing vertex of a ring twice
+        closing = numpy.zeros(len(index), bool)
+        closing[ring_ends] = index[ring_ends] == index[ring_starts]
+        rings = numpy.bincount(index[~closing], minlength=unique_count)[index]
+        change = numpy.zeros(len(index), bool)
+        change[1:] = rings[1:] != rings[:-1]
+        change[:-1] |= rings[:-1] != rings[1:]
+        fixed |= change | (rings > 2)
+
+        # a vertex fixed in one of its rings is fixed in all of them, so a
+        # shared arc has the same ends in each
+        fixed_vertices = numpy.zeros(unique_count, bool)
+        fixed_vertices[index[fixed]] = True
+        fixed = fixed_vertices[index]
+
+        # a shared vertex is as significant as in the most demanding of its
+        # rings; a shared arc is the same in all of them anyway
+        ranks = numpy.zeros(unique_count, numpy.float64)
+        numpy.maximum.at(ranks, index, significance(self.coords(),
+            numpy.flatnonzero(fixed)))
+        keep = ranks == numpy.inf
+        if keep.sum() < vertex_count:
+            keep |= ranks >= numpy.sort(ranks)[-vertex_count]
+
+        kept = keep[index]
+        coarse_counts = numpy.bincount(numpy.repeat(numpy.arange(len(
+            ring_counts)), ring_counts)[kept], minlength=len(ring_counts))
+        ring_offsets = offsets_from_counts(coarse_counts)
+
+        if self.vertex_index is None:
+            vertex_index = None
+            segment_offsets = ring_offsets
+        else:
+            # the kept vertices are still numbered in order of first
+            # appearance
+            vertex_index = (numpy.cumsum(keep) - 1)[index[kept]]
+            first = numpy.unique(vertex_index, return_index=True)[1]
+            segment_offsets = numpy.searchsorted(first, ring_offsets)
+
+        (handle, path) = tempfile.mkstemp(suffix='.cartogram', dir=directory)
+        os.close(handle)
+
+        coordinates = CoordinateBuffer(path, vertex_index, ring_offsets,
+            self.part_offsets, self.feature_offsets, segment_offsets, 'w+')
+        coordinates.vertices[:] = self.vertices[keep]
+        coordinates.flush()
+
+        return (coordinates, keep)
+
+    def interpolate(self, keep, displacement):
+        """Spread the displacement of the kept vertices over all vertices.
+
+        keep is the mask returned by simplify and displacement a (K, 2) array
+        with the displacement of each kept vertex. Every other vertex is
+        displaced by a linear interpolation between the kept vertices before
+        and after it along its ring, weighted by the distance along the ring.
+        Returns a (U, 2) array.
+        """
+
+        index = self.vertex_index
+        if index is None:
+            index = numpy.arange(self.ring_vertex_count())
+
+        known = numpy.zeros((self.vertex_count(), 2), numpy.float64)
+        known[keep] = displacement
+
+        # the first and last vertex of every ring are kept, so the nearest
+        # kept vertices never belong to a different ring
+        positions = numpy.arange(len(index))
+        kept = keep[index]
+        before = numpy.maximum.accumulate(numpy.where(kept, positions, 0))
+        after = numpy.minimum.accumulate(numpy.where(kept, positions,
+            len(index) - 1)[::-1])[::-1]
+
+        coords = self.coords()
+        distance = numpy.zeros(len(coords))
+        distance[1:] = numpy.cumsum(numpy.hypot(*numpy.diff(coords, axis=0).T))
+        span = distance[after] - distance[before]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            weight = numpy.where(span > 0,
+                (distance - distance[before]) / span, 0)[:, numpy.newaxis]
+
+        interpolated = (1 - weight) * known[index[before]] + \
+            weight * known[index[after]]
+
+        # a vertex shared by several rings takes the value of the first
+        first = numpy.unique(index, return_index=True)[1]
+
+        return interpolated[first]
+
+    def spec(self):
+        """Return the arguments to map this buffer in another process."""
+        return (self.path, self.vertex_index, self.ring_offsets,
+            self.part_offsets, self.feature_offsets, self.segment_offsets)
+
+    def feature_count(self):
+        """Return the number of features stored in the buffer."""
+        return len(self.feature_offsets) - 1
+
+    def vertex_count(self):
+        """Return the number of unique vertices stored in the buffer."""
+        return len(self.vertices)
+
+    def ring_vertex_count(self):
+        """Return the number of vertices of all rings, shared ones included."""
+        return int(self.ring_offsets[-1])
+
+    def extent(self):
+        """Return the bounding box (x_min, y_min, x_max, y_max) of the
+        vertices."""
+
+        if self.vertex_count() == 0:
+            return (0.0, 0.0, 0.0, 0.0)
+
+        (x_min, y_min) = self.vertices.min(axis=0)
+        (x_max, y_max) = self.vertices.max(axis=0)
+
+        return (float(x_min), float(y_min), float(x_max), float(y_max))
+
+    def coords(self, start=0, end=None):
+        """Return the vertices of a range of rings as a single (N, 2) array.
+
+        By default, the vertices of all rings are returned.
+        """
+
+        if end is None:
+            end = len(self.ring_offsets) - 1
+
+        first = self.ring_offsets[start]
+        last = self.ring_offsets[end]
+        if self.vertex_index is None:
+            return numpy.array(self.vertices[first:last])
+
+        return self.vertices[self.vertex_index[first:last]]
+
+    def polygons(self, index, step=1):
+        """Return the geometry of a feature as a list of lists of rings.
+
+        With a step greater than one, only every step-th vertex of each ring
+        is returned (and enough others to keep it a closed ring), which gives
+        a coarse outline for previews.
+        """
+
+        polygons = []
+        for part in range(self.feature_offsets[index],
+            self.feature_offsets[index + 1]):
+            rings = []
+            for ring in range(self.part_offsets[part],
+                self.part_offsets[part + 1]):
+                coords = self.coords(ring, ring + 1)
+                if step > 1 and len(coords) > 4:
+                    count = len(coords)
+                    coords = coords[numpy.unique(numpy.concatenate((
+                        numpy.arange(0, count, step),
+                        [count // 3, 2 * count // 3, count - 1])))]
+                rings.append(coords)
+            polygons.append(rings)
+
+        return polygons
+
+    def segments(self, start, end):
+        """Return the ring segments within a range of unique vertices.
+
+        The offsets are relative to start and include both ends of the range,
+        so segments cut by the range boundaries are cut short.
+        """
+
+        offsets = self.segment_offsets
+        inner = numpy.unique(offsets[(offsets > start) & (offsets < end)])
+
+        return numpy.concatenate(([start], inner, [end])) - start
+
+    def measure(self):
+        """Calculate the area and the centroid of every feature.
+
+        Uses the shoelace formula, on as many whole rings at once as fit into
+        CHUNK_SIZE vertices. Holes are subtracted from the exterior ring of
+        their part regardless of the orientation of the rings. Returns a tuple
+        of three arrays: area, center_x, center_y.
+        """
+
+        feature_count = self.feature_count()
+        ring_count = len(self.ring_offsets) - 1
+        part_count = len(self.part_offsets) - 1
+
+        part_feature = numpy.repeat(numpy.arange(feature_count),
+            numpy.diff(self.feature_offsets))
+        ring_part = numpy.repeat(numpy.arange(part_count),
+            numpy.diff(self.part_offsets))
+        ring_feature = part_feature[ring_part]
+
+        signed_area = numpy.zeros(ring_count)
+        ring_x = numpy.zeros(ring_count)
+        ring_y = numpy.zeros(ring_count)
+        sum_x = numpy.zeros(ring_count)
+        sum_y = numpy.zeros(ring_count)
+
+        start = 0
+        while start < ring_count:
+            # at least one ring, however many vertices it has
+            end = max(int(numpy.searchsorted(self.ring_offsets,
+                self.ring_offsets[start] + CHUNK_SIZE, 'right')) - 1,
+                start + 1)
+            end = min(end, ring_count)
+
+            (signed_area[start:end], ring_x[start:end], ring_y[start:end],
+                sum_x[start:end], sum_y[start:end]) = self.measure_rings(
+                start, end)
+
+            start = end
+
+        # exterior rings add to the area of a feature, holes subtract from it
+        weight = numpy.abs(signed_area)
+        holes = numpy.ones(ring_count, bool)
+        holes[self.part_offsets[:-1]] = False
+        weight[holes] *= -1
+
+        area = numpy.bincount(ring_feature, weight, feature_count)
+        center_x = numpy.bincount(ring_feature, weight * ring_x,
+            feature_count)
+        center_y = numpy.bincount(ring_feature, weight * ring_y,
+            feature_count)
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            center_x /= area
+            center_y /= area
+
+        # degenerate features without any area use the mean of their vertices
+        degenerate = area == 0
+        if degenerate.any():
+            counts = numpy.bincount(ring_feature,
+                numpy.diff(self.ring_offsets), feature_count)
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                mean_x = numpy.bincount(ring_feature, sum_x,
+                    feature_count) / counts
+                mean_y = numpy.bincount(ring_feature, sum_y,
+                    feature_count) / counts
+            center_x[degenerate] = mean_x[degenerate]
+            center_y[degenerate] = mean_y[degenerate]
+
+            # features without any vertices have neither area nor centroid
+            center_x[counts == 0] = 0
+            center_y[counts == 0] = 0
+
+        return (area, center_x, center_y)
+
+    def measure_rings(self, start, end):
+        """Calculate the signed area and the centroid of a range of rings.
+
+        Returns five arrays with one entry per ring: the signed area, the
+        centroid (x and y) and the sums of the x and y coordinates of the
+        vertices.
+        """
+
+        ring_count = end - start
+        ring_offsets = self.ring_offsets[start:end + 1] - self.ring_offsets[
+            start]
+        ring_starts = ring_offsets[:-1]
+        ring_index = numpy.repeat(numpy.arange(ring_count),
+            numpy.diff(ring_offsets))
+
+        coords = self.coords(start, end)
+
+        # work relative to the first vertex of each ring to avoid losing
+        # precision with large projected coordinates
+        origin = coords[ring_starts]
+        local = coords - origin[ring_index]
+        x = local[:, 0]
+        y = local[:, 1]
+
+        # index of the following vertex, wrapping around at the end of a ring
+        following = numpy.arange(1, len(local) + 1)
+        following[ring_offsets[1:] - 1] = ring_starts
+        x1 = x[following]
+        y1 = y[following]
+
+        cross = x * y1 - x1 * y
+
+        signed_area = numpy.bincount(ring_index, cross, ring_count) / 2
+        moment_x = numpy.bincount(ring_index, (x + x1) * cross, ring_count)
+        moment_y = numpy.bincount(ring_index, (y + y1) * cross, ring_count)
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            ring_x = numpy.where(signed_area != 0,
+                moment_x / (6 * signed_area), 0) + origin[:, 0]
+            ring_y = numpy.where(signed_area != 0,
+                moment_y / (6 * signed_area), 0) + origin[:, 1]
+
+        sum_x = numpy.bincount(ring_index, coords[:, 0], ring_count)
+        sum_y = numpy.bincount(ring_index, coords[:, 1], ring_count)
+
+        return (signed_area, ring_x, ring_y, sum_x, sum_y)
+
+    def flush(self):
+        """Write pending changes to the backing file."""
+        if isinstance(self.vertices, numpy.memmap):
+            self.vertices.flush()
+
+    def close(self):
+        """Release the mapping and delete the backing file."""
+
+        self.vertices = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
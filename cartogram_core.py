@@ -0,0 +1,577 @@
+# -*- coding: utf-8 -*-
+
+"""Cartogram solver which works on plain arrays and does not need QGIS."""
+
+from cartogram_culling import CulledField
+from cartogram_engine import (ForceField, check_backend, error_report,
+    feature_arrays)
+from cartogram_feature import CartogramFeatures
+from cartogram_grid import GridField, GridTracer
+from cartogram_pool import create_pool
+from cartogram_quadtree import QuadTree
+from cartogram_stats import Stopwatch, profile
+
+import math
+import multiprocessing
+import os
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import numpy
+
+# upper limit of the number of vertices transformed by a single task, which
+# bounds the memory a worker process needs for its temporary arrays
+TASK_SIZE = 1 << 20
+
+# number of iterations run on all vertices after the coarse ones
+REFINE_ITERATIONS = 2
+
+
+def prepare_values(values, min_value=None):
+    """Convert the values of the features into an array of target sizes.
+
+    Zero and None values are replaced by a hundredth of min_value, which
+    defaults to the smallest valid value. Returns the array and the minimum
+    value used.
+    """
+
+    values = numpy.array([0 if value is None else value for value in values],
+        numpy.float64)
+
+    missing = values == 0
+    if missing.any():
+        if missing.all():
+            raise ValueError(u'The values only contain zero or NULL.')
+        if min_value is None:
+            min_value = values[~missing].min()
+        values[missing] = min_value / 100
+
+    return (values, min_value)
+
+
+def reduction_factor(coordinates, values):
+    """Calculate the reduction factor.
+
+    Areas and centroids are measured on the current state of the coordinate
+    buffer. Returns a CartogramFeatures store of all features, the force
+    reduction factor, and the mean and max size error in percent.
+    """
+
+    features = CartogramFeatures(len(values))
+
+    (area, features.center_x, features.center_y) = coordinates.measure()
+    area = numpy.maximum(area, 0)
+    features.value = values
+    features.area = area
+
+    fraction = area.sum() / values.sum()
+
+    # this is our 'desired' area...
+    desired_area = values * fraction
+
+    # calculate radius, a zero area is zero radius
+    radius = features.radius = numpy.sqrt(area / math.pi)
+    features.mass = numpy.where(desired_area > 0,
+        numpy.sqrt(desired_area / math.pi) - radius, 0)
+
+    # features without any area (e.g. empty geometries) cannot be
+    # compared with their desired area
+    valid = (area > 0) & (desired_area > 0)
+    size_error = numpy.maximum(area[valid], desired_area[valid]) / \
+        numpy.minimum(area[valid], desired_area[valid])
+
+    average_error = size_error.mean() if len(size_error) else 1.0
+    max_error = size_error.max() if len(size_error) else 1.0
+    force_reduction_factor = 1 / (average_error + 1)
+
+    return (features, force_reduction_factor,
+        (average_error - 1) * 100, (max_error - 1) * 100)
+
+
+def get_chunks(vertex_count, count, boundaries=None):
+    """Split the unique vertices into ranges of roughly equal size.
+
+    With boundaries (the segment offsets of a coordinate buffer), a range
+    ends at the nearest boundary if that is at most a quarter of the range
+    size away, so that only rings much larger than a range are cut into
+    pieces.
+    """
+
+    bounds = numpy.linspace(0, vertex_count, count + 1)
+
+    if boundaries is not None and len(boundaries) > 1:
+        index = numpy.clip(numpy.searchsorted(boundaries, bounds), 1,
+            len(boundaries) - 1)
+        lower = boundaries[index - 1]
+        upper = boundaries[index]
+        nearest = numpy.where(bounds - lower < upper - bounds, lower, upper)
+        bounds = numpy.where(numpy.abs(nearest - bounds) <=
+            vertex_count / (4.0 * count), nearest, bounds)
+
+    bounds = numpy.unique(bounds.astype(numpy.int64))
+
+    return [(int(start), int(end))
+        for (start, end) in zip(bounds[:-1], bounds[1:])]
+
+
+def ignore(*args):
+    """Default callback which does nothing."""
+    pass
+
+
+class CartogramSolver(object):
+    """Distorts the features of a coordinate buffer towards their values.
+
+    This is the Dougenik et al. algorithm without any dependency on QGIS: the
+    geometries come in a CoordinateBuffer, which is transformed in place, and
+    the values in a list or array in the order of its features. Progress,
+    feedback and cancellation are handled by plain callables:
+
+    - feedback(message) receives log messages,
+    - progress(percent) receives the progress of the iterations,
+    - cancelled() is polled regularly and stops the solver if it returns True,
+    - stopped() is polled before each iteration; if it returns True the
+      solver finishes early, keeping the result of the iterations so far,
+    - iteration_finished(iterations, coordinates) is called after each
+      iteration with the number of iterations done so far,
+    - statistics(record) receives a dict with the size errors and the wall
+      clock and CPU time of the stages of each iteration, as well as the
+      time the worker processes spent on it.
+    """
+
+    def __init__(self, coordinates, values, iterations, theta=0, tolerance=0,
+        target_mean_error=0, target_max_error=0, processes=None, pool=None,
+        first_iteration=0, cache=None, checkpoint_interval=1,
+        profile_iteration=0, profile_path=None, backend=None,
+        coarse_vertices=0, refine_iterations=REFINE_ITERATIONS, grid_size=0,
+        grid_path=None, feedback=None,
+        progress=None, cancelled=None, stopped=None, iteration_finished=None,
+        statistics=None):
+        """Constructor.
+
+        A theta greater than zero approximates the force field with a
+        Barnes-Hut quadtree, larger values are faster and less accurate.
+        Otherwise a tolerance (in map units) greater than zero evaluates
+        features which move a vertex by less than the tolerance only coarsely.
+        Otherwise a grid_size (in map units) greater than zero evaluates the
+        field on a grid with cells of that size and interpolates it at the
+        vertices. With a grid_path, the total displacement of the iterations,
+        sampled on a grid with cells of grid_size over the original extent,
+        is saved there as a cartogram_grid.DisplacementGrid; as every
+        iteration is needed for it, no results are restored from the cache.
+        The vertices are transformed by the given number of processes, by
+        default one per CPU; a single process works without a pool. A pool
+        which is already running for the coordinate buffer can be passed
+        instead, it is left running when the solver is done.
+
+        To resume an interrupted run, pass a coordinate buffer which has
+        already been through first_iteration iterations. With a ResultCache,
+        a checkpoint is stored after every checkpoint_interval iterations and
+        after the last one, and a new run starts from the latest checkpoint
+        of the same job. A checkpoint_interval of zero neither stores nor
+        restores any checkpoints.
+
+        With a profile_path, iteration number profile_iteration (counting from
+        one) is profiled in the current process and the statistics are
+        written to that file.
+
+        backend selects the implementation of the force kernel, one of
+        cartogram_engine.BACKENDS; by default Numba is used if it is
+        installed. All backends produce the same result up to rounding.
+
+        With coarse_vertices greater than zero, and a buffer with more
+        (shared) unique vertices than that, all but the last
+        refine_iterations iterations run on a copy of the rings simplified to
+        about coarse_vertices vertices. Their displacement is then
+        interpolated onto the remaining vertices, and the last iterations
+        refine the result at full resolution.
+
+        With a target mean and/or max size error (in percent) greater than
+        zero, the solver stops as soon as the errors drop below the targets,
+        and iterations becomes the maximum number of iterations.
+        """
+
+        self.coordinates = coordinates
+        self.values = numpy.asarray(values, numpy.float64)
+        self.iterations = iterations
+        self.theta = theta
+        self.tolerance = tolerance
+        self.backend = check_backend(backend)
+        self.coarse_vertices = coarse_vertices
+        self.refine_iterations = max(1, refine_iterations)
+        self.grid_size = grid_size
+        self.grid_path = grid_path
+        self.target_mean_error = target_mean_error
+        self.target_max_error = target_max_error
+        self.processes = processes
+        self.pool = pool
+        self.first_iteration = first_iteration
+        self.cache = cache
+        self.checkpoint_interval = max(0, checkpoint_interval)
+        self.profile_iteration = profile_iteration
+        self.profile_path = profile_path
+
+        self.feedback = feedback or ignore
+        self.progress = progress or ignore
+        self.cancelled = cancelled or (lambda: False)
+        self.stopped = stopped or (lambda: False)
+        self.iteration_finished = iteration_finished or ignore
+        self.statistics = statistics or ignore
+
+        # mean and max size error (in percent) before each iteration and after
+        # the last one, starting at error_curve_start
+        self.error_curve = []
+        self.error_curve_start = first_iteration
+
+        # number of iterations the coordinates have been through
+        self.iterations_done = first_iteration
+
+        # follows the nodes of the exported grid
+        self.tracer = None
+        if grid_path is not None:
+            if grid_size <= 0:
+                raise ValueError(u'Exporting the displacement grid needs a '
+                    u'grid size.')
+            self.tracer = GridTracer(coordinates.extent(), grid_size)
+
+    def run(self):
+        """Run all iterations, return False if the solver was cancelled."""
+
+        coordinates = self.coordinates
+
+        key = None
+        if self.cache is not None and self.checkpoint_interval > 0 and \
+            self.first_iteration == 0:
+            options = {"theta": self.theta, "tolerance": self.tolerance}
+            if self.coarse():
+                options["coarse_vertices"] = self.coarse_vertices
+                options["refine_iterations"] = self.refine_iterations
+            if self.grid_size > 0:
+                options["grid_size"] = self.grid_size
+            key = self.cache.key(coordinates, self.values, options)
+            if self.tracer is None:
+                (self.first_iteration, self.error_curve) = self.cache.load(
+                    key, coordinates, self.iterations)
+                self.error_curve_start = 0
+                if self.first_iteration > 0:
+                    self.feedback(u"restored the result of {} iterations "
+                        u"from the cache".format(self.first_iteration))
+
+                # a finished run, which needs neither the worker processes
+                # nor another measurement of the size errors
+                if self.complete():
+                    self.iterations_done = self.first_iteration
+                    self.report_error_curve()
+                    return True
+                del self.error_curve[self.first_iteration:]
+
+        # the coarse iterations report the first part of the progress
+        progress_start = 0
+        if self.first_iteration == 0 and self.coarse():
+            progress_start = self.run_coarse()
+            if progress_start is None:
+                return False
+
+        processes = self.processes or multiprocessing.cpu_count()
+        chunks = get_chunks(coordinates.vertex_count(), max(processes * 4,
+            int(math.ceil(coordinates.vertex_count() / float(TASK_SIZE)))),
+            coordinates.segment_offsets)
+
+        # the worker processes are started once and reused by all iterations
+        pool = self.pool
+        if pool is None and self.first_iteration < self.iterations:
+            pool = create_pool(coordinates, processes)
+
+        total_steps = coordinates.vertex_count() * (self.iterations -
+            self.first_iteration)
+        steps = 0
+        converged = False
+        finished = False
+
+        # number of iterations the coordinates have been through
+        done = self.first_iteration
+
+        field = None
+        try:
+            for i in range(self.first_iteration, self.iterations):
+                if self.cancelled():
+                    break
+                if self.stopped():
+                    self.feedback(u"stopped after {} iterations".format(i))
+                    break
+
+                stopwatch = Stopwatch()
+                (task_wall, task_cpu) = (pool.task_wall, pool.task_cpu)
+
+                with profile(self.profile_path
+                    if i + 1 == self.profile_iteration else None):
+                    with stopwatch.measure('reduction_factor'):
+                        (features, force_reduction_factor, mean_error,
+                            max_error) = reduction_factor(coordinates,
+                                self.values)
+
+                    self.error_curve.append((mean_error, max_error))
+                    if self.converged(mean_error, max_error):
+                        self.feedback(u"size error targets reached after {} "
+                            u"iterations".format(i))
+                        converged = True
+                        break
+
+                    self.feedback(u"starting iteration {} of {} (mean size "
+                        u"error {:.2f}%, max size error {:.2f}%)".format(i+1,
+                            self.iterations, mean_error, max_error))
+
+                    if field is not None:
+                        pool.release(field)
+                    with stopwatch.measure('force_field'):
+                        field = self.get_force_field(features,
+                            force_reduction_factor, pool)
+                    if self.cancelled():
+                        break
+                    if self.theta > 0 or self.tolerance > 0 or \
+                        self.grid_size > 0:
+                        with stopwatch.measure('error_report'):
+                            self.report_error(field, force_reduction_factor)
+
+                    # the field is pickled once for every task sent to the
+                    # worker processes, measure what a single copy costs
+                    field_bytes = 0
+                    if self.statistics is not ignore:
+                        with stopwatch.measure('serialization'):
+                            field_bytes = len(pickle.dumps(field,
+                                pickle.HIGHEST_PROTOCOL))
+
+                    with stopwatch.measure('transform'):
+                        for (start, end) in pool.transform(chunks, field,
+                            force_reduction_factor):
+                            if self.cancelled():
+                                break
+
+                            steps += end - start
+                            self.progress(progress_start + steps /
+                                float(total_steps) * (100 - progress_start))
+
+                    if self.cancelled():
+                        break
+
+                    if self.tracer is not None:
+                        with stopwatch.measure('grid_tracer'):
+                            self.tracer.transform(field,
+                                force_reduction_factor)
+
+                    # the last iteration is stored once the run is done
+                    done = i + 1
+                    if key is not None and done < self.iterations and \
+                        done % self.checkpoint_interval == 0:
+                        with stopwatch.measure('checkpoint'):
+                            coordinates.flush()
+                            self.cache.store(key, done, coordinates,
+                                self.error_curve[:done])
+
+                transform_wall = stopwatch.stages['transform']['wall']
+                self.statistics({
+                    'type': 'iteration',
+                    'iteration': done,
+                    'mean_error': mean_error,
+                    'max_error': max_error,
+                    'stages': stopwatch.stages,
+                    'workers': {'wall': pool.task_wall - task_wall,
+                        'cpu': pool.task_cpu - task_cpu},
+                    'tasks': len(chunks),
+                    'field_bytes': field_bytes,
+                    'vertices': coordinates.vertex_count(),
+                    'throughput': coordinates.vertex_count() /
+                        max(transform_wall, 1e-9),
+                })
+
+                self.iteration_finished(done, coordinates)
+
+            finished = not self.cancelled()
+        finally:
+            # the pool closes the fields once its processes have exited
+            if field is not None:
+                pool.release(field)
+
+            # don't wait for outstanding tasks after a failure or cancellation
+            if pool is not None and pool is not self.pool:
+                if finished:
+                    pool.close()
+                else:
+                    pool.terminate()
+
+        # a cancelled iteration leaves the coordinates half transformed, so
+        # only a finished run stores its final state
+        if not finished:
+            return False
+
+        # the workers don't flush the shared vertices after each task
+        coordinates.flush()
+
+        self.iterations_done = done
+        if not converged:
+            self.error_curve.append(
+                reduction_factor(coordinates, self.values)[2:])
+
+        # the final checkpoint holds the size errors after the last
+        # iteration as well, which marks the run as complete
+        if key is not None and done > 0:
+            self.cache.store(key, done, coordinates, self.error_curve)
+        self.report_error_curve()
+
+        if self.grid_path is not None:
+            self.tracer.grid().save(self.grid_path)
+            self.feedback(u"saved the displacement grid to {}".format(
+                self.grid_path))
+
+        return True
+
+    def coarse(self):
+        """Check whether the first iterations run on simplified rings.
+
+        Rings which do not share their vertices would be simplified
+        differently on either side of a border, so they are always solved
+        at full resolution.
+        """
+        return 0 < self.coarse_vertices < self.coordinates.vertex_count() and \
+            self.iterations > self.refine_iterations and \
+            self.coordinates.vertex_index is not None
+
+    def run_coarse(self):
+        """Run all but the last iterations on simplified rings.
+
+        The displacement of the simplified rings is interpolated onto the
+        full resolution coordinates, which then count as having been through
+        the iterations run. Returns the share of the progress (in percent)
+        taken by the coarse iterations, or None if the solver was cancelled.
+        """
+
+        coordinates = self.coordinates
+        (coarse, keep) = coordinates.simplify(self.coarse_vertices,
+            os.path.dirname(coordinates.path))
+
+        try:
+            self.feedback(u"solving on {} of {} vertices before refining the "
+                u"last {} iterations".format(coarse.vertex_count(),
+                    coordinates.vertex_count(), self.refine_iterations))
+
+            coarse_iterations = self.iterations - self.refine_iterations
+            coarse_steps = coarse.vertex_count() * coarse_iterations
+            share = coarse_steps * 100.0 / (coarse_steps +
+                coordinates.vertex_count() * self.refine_iterations)
+
+            original = numpy.array(coarse.vertices)
+            solver = CartogramSolver(coarse, self.values, coarse_iterations,
+                theta=self.theta, tolerance=self.tolerance,
+                target_mean_error=self.target_mean_error,
+                target_max_error=self.target_max_error,
+                processes=self.processes, backend=self.backend,
+                grid_size=self.grid_size, feedback=self.feedback,
+                progress=lambda percent: self.progress(percent * share / 100),
+                cancelled=self.cancelled, stopped=self.stopped,
+                iteration_finished=self.iteration_finished,
+                statistics=lambda record: self.statistics(dict(record,
+                    resolution='coarse')))
+            solver.tracer = self.tracer
+            if not solver.run():
+                return None
+
+            coordinates.vertices += coordinates.interpolate(keep,
+                coarse.vertices - original)
+            coordinates.flush()
+        finally:
+            coarse.close()
+
+        # the size errors of the coarse iterations, measured on the
+        # simplified rings
+        done = solver.iterations_done
+        self.first_iteration = self.iterations_done = done
+        self.error_curve = solver.error_curve[:done]
+        self.error_curve_start = 0
+
+        return share
+
+    def complete(self):
+        """Check whether the restored checkpoint is the result of the run.
+
+        That is the case if it holds the size errors after its last
+        iteration, and either it has been through all iterations or these
+        errors reach the targets.
+        """
+
+        done = self.first_iteration
+        if done == 0 or len(self.error_curve) <= done:
+            return False
+
+        return done == self.iterations or \
+            self.converged(*self.error_curve[done])
+
+    def converged(self, mean_error, max_error):
+        """Check whether the size errors have reached their targets."""
+
+        if self.target_mean_error <= 0 and self.target_max_error <= 0:
+            return False
+
+        return (self.target_mean_error <= 0 or
+                mean_error <= self.target_mean_error) and \
+            (self.target_max_error <= 0 or max_error <= self.target_max_error)
+
+    def report_error_curve(self):
+        """Log the mean and max size error over the iterations."""
+
+        curve = u", ".join(u"{}: {:.2f}%/{:.2f}%".format(i, mean_error,
+            max_error) for (i, (mean_error, max_error))
+            in enumerate(self.error_curve, self.error_curve_start))
+        self.feedback(u"mean/max size error after each iteration: "
+            u"{}".format(curve))
+
+    def get_force_field(self, features, force_reduction_factor, pool):
+        """Build the exact or the approximated force field.
+
+        The nodes of a grid field are evaluated by the pool.
+        """
+
+        arrays = feature_arrays(features)
+        if self.theta > 0:
+            return QuadTree(*arrays, theta=self.theta, backend=self.backend)
+        if self.tolerance > 0:
+            return CulledField(*arrays,
+                force_reduction_factor=force_reduction_factor,
+                tolerance=self.tolerance, backend=self.backend)
+        if self.grid_size > 0:
+            field = GridField(*arrays, extent=self.coordinates.extent(),
+                cell_size=self.grid_size,
+                directory=os.path.dirname(self.coordinates.path),
+                backend=self.backend)
+            for (start, end) in pool.evaluate(field):
+                if self.cancelled():
+                    break
+            return field
+
+        return ForceField(*arrays, backend=self.backend)
+
+    def report_error(self, field, force_reduction_factor):
+        """Report how far the approximation deviates from the exact field."""
+
+        report = error_report(field, self.coordinates.vertices,
+            force_reduction_factor)
+
+        if self.theta > 0:
+            method = u"Barnes-Hut approximation (theta {:.2f})".format(
+                self.theta)
+        elif self.tolerance > 0:
+            method = u"influence culling (tolerance {:.6g})".format(
+                self.tolerance)
+        else:
+            method = u"displacement grid (cell size {:.6g})".format(
+                self.grid_size)
+
+        speedup = report['exact_time'] / max(report['approximate_time'],
+            1e-9)
+        self.feedback(u"{}: mean error {:.6g}, max error {:.6g}, mean "
+            u"displacement {:.6g} (sample of {} vertices, {:.1f}x faster "
+            u"than exact)".format(method, report['mean_error'],
+                report['max_error'], report['mean_displacement'],
+                report['sample_size'], speedup))
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+"""Influence culling: evaluate features far away from a vertex coarsely."""
+
+from cartogram_engine import BLOCK_SIZE, ForceField, displacement
+
+import numpy
+
+# rings longer than this are split into several segments, each of which is
+# culled against its own bounding box
+SEGMENT_SIZE = 1024
+
+# features whose influence covers more grid cells than this are not stored in
+# the grid but tested against every query directly
+MAX_CELLS_PER_FEATURE = 64
+
+
+def influence_radius(mass, radius, force_reduction_factor, tolerance):
+    """Calculate the distance beyond which a feature is negligible.
+
+    Outside of its radius a feature displaces a vertex at distance d by
+    force_reduction_factor * |mass| * radius / d, so beyond the returned
+    distance the displacement is smaller than the tolerance. Vertices within
+    the radius of a feature are always influenced by it.
+    """
+    return numpy.maximum(radius,
+        force_reduction_factor * numpy.abs(mass) * radius / tolerance)
+
+
+def merge_segments(segments, size):
+    """Merge consecutive segments of an offset array into runs of at most
+    size vertices.
+
+    Segments which are longer than size on their own are kept as they are.
+    """
+
+    merged = [segments[0]]
+    for (offset, next_offset) in zip(segments[1:-1], segments[2:]):
+        if next_offset - merged[-1] > size:
+            merged.append(offset)
+    merged.append(segments[-1])
+
+    return merged
+
+
+class InfluenceIndex(object):
+    """Uniform grid over the circles of influence of the features.
+
+    Each feature is registered in every cell its circle of influence
+    overlaps; features with very large circles are kept in a separate list
+    which is checked on every query.
+    """
+
+    def __init__(self, center_x, center_y, reach):
+        """Constructor."""
+
+        self.center_x = center_x
+        self.center_y = center_y
+        self.reach = reach
+
+        feature_count = len(center_x)
+        if feature_count == 0:
+            self.large = numpy.zeros(0, numpy.int64)
+            self.cell_size = 1.0
+            self.columns = self.rows = 0
+            return
+
+        self.x_min = (center_x - reach).min()
+        self.y_min = (center_y - reach).min()
+        width = (center_x + reach).max() - self.x_min
+        height = (center_y + reach).max() - self.y_min
+
+        # aim for a few features per cell
+        self.cell_size = max(numpy.sqrt(width * height / feature_count),
+            numpy.median(reach), 1e-12)
+        self.columns = int(width // self.cell_size) + 1
+        self.rows = int(height // self.cell_size) + 1
+
+        (column_min, row_min) = self.cell(center_x - reach, center_y - reach)
+        (column_max, row_max) = self.cell(center_x + reach, center_y + reach)
+        cells = (column_max - column_min + 1) * (row_max - row_min + 1)
+
+        large = cells > MAX_CELLS_PER_FEATURE
+        self.large = numpy.flatnonzero(large)
+
+        # list every (cell, feature) pair and sort them by cell, so that the
+        # features of cell c are members[starts[c]:starts[c + 1]]
+        cell_ids = []
+        feature_ids = []
+        for feature in numpy.flatnonzero(~large):
+            columns = numpy.arange(column_min[feature],
+                column_max[feature] + 1)
+            rows = numpy.arange(row_min[feature], row_max[feature] + 1)
+            ids = (rows[:, numpy.newaxis] * self.columns + columns).ravel()
+            cell_ids.append(ids)
+            feature_ids.append(numpy.repeat(feature, len(ids)))
+
+        if cell_ids:
+            cell_ids = numpy.concatenate(cell_ids)
+            feature_ids = numpy.concatenate(feature_ids)
+        else:
+            cell_ids = feature_ids = numpy.zeros(0, numpy.int64)
+
+        order = numpy.argsort(cell_ids, kind='mergesort')
+        self.members = feature_ids[order]
+        self.starts = numpy.searchsorted(cell_ids[order],
+            numpy.arange(self.columns * self.rows + 1))
+
+    def cell(self, x, y):
+        """Return the column and row of the cells containing the points."""
+
+        column = numpy.clip(((x - self.x_min) // self.cell_size).astype(
+            numpy.int64), 0, self.columns - 1)
+        row = numpy.clip(((y - self.y_min) // self.cell_size).astype(
+            numpy.int64), 0, self.rows - 1)
+
+        return (column, row)
+
+    def query(self, x_min, y_min, x_max, y_max):
+        """Return the features which influence any point of a bounding box."""
+
+        candidates = [self.large]
+
+        if self.columns > 0:
+            (column_min, row_min) = self.cell(numpy.array(x_min),
+                numpy.array(y_min))
+            (column_max, row_max) = self.cell(numpy.array(x_max),
+                numpy.array(y_max))
+            for row in range(row_min, row_max + 1):
+                start = self.starts[row * self.columns + column_min]
+                end = self.starts[row * self.columns + column_max + 1]
+                candidates.append(self.members[start:end])
+
+        candidates = numpy.unique(numpy.concatenate(candidates))
+
+        # exact test: distance between the centroid and the bounding box
+        dx = numpy.maximum(0, numpy.maximum(x_min - self.center_x[candidates],
+            self.center_x[candidates] - x_max))
+        dy = numpy.maximum(0, numpy.maximum(y_min - self.center_y[candidates],
+            self.center_y[candidates] - y_max))
+
+        return candidates[numpy.hypot(dx, dy) <= self.reach[candidates]]
+
+
+class CulledField(ForceField):
+    """Force field which evaluates distant features only coarsely.
+
+    Each feature gets a circle of influence outside of which it moves a
+    vertex by less than the tolerance (in map units). The vertices are
+    processed in ring segments: features whose circle of influence intersects
+    the bounding box of a segment are evaluated at every vertex. The smooth
+    field of all other features is evaluated at the corners of the bounding
+    box only and interpolated bilinearly, so no force is skipped.
+    """
+
+    def __init__(self, center_x, center_y, mass, radius,
+        force_reduction_factor, tolerance, block_size=BLOCK_SIZE,
+        backend=None):
+        """Constructor."""
+
+        ForceField.__init__(self, center_x, center_y, mass, radius,
+            block_size, backend)
+
+        self.tolerance = tolerance
+        self.index = InfluenceIndex(center_x, center_y, influence_radius(
+            mass, radius, force_reduction_factor, tolerance))
+
+    def displacement(self, coords, force_reduction_factor, segments=None):
+        """Compute the displacement of each vertex, segment by segment.
+
+        segments is an offset array of the rings in coords; without it the
+        vertices are simply split into runs of SEGMENT_SIZE. Consecutive
+        segments, usually neighbouring rings, are merged up to SEGMENT_SIZE
+        vertices, as most rings only introduce a few new vertices and the
+        far field costs the same for every segment.
+        """
+
+        result = numpy.zeros((len(coords), 2), numpy.float64)
+
+        if segments is None:
+            segments = [0, len(coords)]
+        else:
+            segments = merge_segments(segments, SEGMENT_SIZE)
+
+        for (start, end) in zip(segments[:-1], segments[1:]):
+            for split in range(start, end, SEGMENT_SIZE):
+                points = coords[split:min(end, split + SEGMENT_SIZE)]
+                result[split:split + len(points)] = self.segment_displacement(
+                    points, force_reduction_factor)
+
+        return result
+
+    def segment_displacement(self, points, force_reduction_factor):
+        """Compute the displacement of the vertices of a single segment."""
+
+        # the far field is evaluated at four corners, which costs more than
+        # evaluating up to four vertices exactly
+        if len(points) <= 4:
+            return displacement(points, self.center_x, self.center_y,
+                self.mass, self.radius, force_reduction_factor,
+                self.block_size, self.backend)
+
+        (x_min, y_min) = points.min(axis=0)
+        (x_max, y_max) = points.max(axis=0)
+        near = self.index.query(x_min, y_min, x_max, y_max)
+
+        result = displacement(points, self.center_x[near],
+            self.center_y[near], self.mass[near], self.radius[near],
+            force_reduction_factor, self.block_size, self.backend)
+
+        if len(near) == len(self.center_x):
+            return result
+
+        # the field of all other features at the corners of the bounding box
+        corners = numpy.array([[x_min, y_min], [x_max, y_min],
+            [x_min, y_max], [x_max, y_max]])
+        far = displacement(corners, self.center_x, self.center_y, self.mass,
+            self.radius, force_reduction_factor, self.block_size, self.backend)
+        far -= displacement(corners, self.center_x[near], self.center_y[near],
+            self.mass[near], self.radius[near], force_reduction_factor,
+            self.block_size, self.backend)
+
+        # bilinear interpolation, degenerate boxes collapse to their edge
+        u = (points[:, 0] - x_min) / (x_max - x_min) if x_max > x_min \
+            else numpy.zeros(len(points))
+        v = (points[:, 1] - y_min) / (y_max - y_min) if y_max > y_min \
+            else numpy.zeros(len(points))
+        u = u[:, numpy.newaxis]
+        v = v[:, numpy.newaxis]
+
+        result += (far[0] * (1 - u) * (1 - v) + far[1] * u * (1 - v) +
+            far[2] * (1 - u) * v + far[3] * u * v)
+
+        return result
@@ -52,11 +52,119 @@ class Ui_CartogramDialog(object):
         self.iterationsSpinBox.setProperty("value", 5)
         self.iterationsSpinBox.setObjectName(_fromUtf8("iterationsSpinBox"))
         self.formLayout.setWidget(4, QtGui.QFormLayout.FieldRole, self.iterationsSpinBox)
+        self.meanErrorLabel = QtGui.QLabel(CartogramDialog)
+        self.meanErrorLabel.setObjectName(_fromUtf8("meanErrorLabel"))
+        self.formLayout.setWidget(5, QtGui.QFormLayout.LabelRole, self.meanErrorLabel)
+        self.meanErrorSpinBox = QtGui.QDoubleSpinBox(CartogramDialog)
+        self.meanErrorSpinBox.setDecimals(1)
+        self.meanErrorSpinBox.setMaximum(1000.0)
+        self.meanErrorSpinBox.setSingleStep(1.0)
+        self.meanErrorSpinBox.setProperty("value", 0.0)
+        self.meanErrorSpinBox.setObjectName(_fromUtf8("meanErrorSpinBox"))
+        self.formLayout.setWidget(5, QtGui.QFormLayout.FieldRole, self.meanErrorSpinBox)
+        self.maxErrorLabel = QtGui.QLabel(CartogramDialog)
+        self.maxErrorLabel.setObjectName(_fromUtf8("maxErrorLabel"))
+        self.formLayout.setWidget(6, QtGui.QFormLayout.LabelRole, self.maxErrorLabel)
+        self.maxErrorSpinBox = QtGui.QDoubleSpinBox(CartogramDialog)
+        self.maxErrorSpinBox.setDecimals(1)
+        self.maxErrorSpinBox.setMaximum(1000.0)
+        self.maxErrorSpinBox.setSingleStep(1.0)
+        self.maxErrorSpinBox.setProperty("value", 0.0)
+        self.maxErrorSpinBox.setObjectName(_fromUtf8("maxErrorSpinBox"))
+        self.formLayout.setWidget(6, QtGui.QFormLayout.FieldRole, self.maxErrorSpinBox)
+        self.thetaLabel = QtGui.QLabel(CartogramDialog)
+        self.thetaLabel.setObjectName(_fromUtf8("thetaLabel"))
+        self.formLayout.setWidget(7, QtGui.QFormLayout.LabelRole, self.thetaLabel)
+        self.thetaSpinBox = QtGui.QDoubleSpinBox(CartogramDialog)
+        self.thetaSpinBox.setDecimals(2)
+        self.thetaSpinBox.setMaximum(2.0)
+        self.thetaSpinBox.setSingleStep(0.1)
+        self.thetaSpinBox.setProperty("value", 0.0)
+        self.thetaSpinBox.setObjectName(_fromUtf8("thetaSpinBox"))
+        self.formLayout.setWidget(7, QtGui.QFormLayout.FieldRole, self.thetaSpinBox)
+        self.toleranceLabel = QtGui.QLabel(CartogramDialog)
+        self.toleranceLabel.setObjectName(_fromUtf8("toleranceLabel"))
+        self.formLayout.setWidget(8, QtGui.QFormLayout.LabelRole, self.toleranceLabel)
+        self.toleranceSpinBox = QtGui.QDoubleSpinBox(CartogramDialog)
+        self.toleranceSpinBox.setDecimals(3)
+        self.toleranceSpinBox.setMaximum(1000.0)
+        self.toleranceSpinBox.setSingleStep(0.1)
+        self.toleranceSpinBox.setProperty("value", 0.0)
+        self.toleranceSpinBox.setObjectName(_fromUtf8("toleranceSpinBox"))
+        self.formLayout.setWidget(8, QtGui.QFormLayout.FieldRole, self.toleranceSpinBox)
+        self.gridLabel = QtGui.QLabel(CartogramDialog)
+        self.gridLabel.setObjectName(_fromUtf8("gridLabel"))
+        self.formLayout.setWidget(9, QtGui.QFormLayout.LabelRole, self.gridLabel)
+        self.gridSpinBox = QtGui.QDoubleSpinBox(CartogramDialog)
+        self.gridSpinBox.setDecimals(1)
+        self.gridSpinBox.setMaximum(1000000.0)
+        self.gridSpinBox.setSingleStep(100.0)
+        self.gridSpinBox.setProperty("value", 0.0)
+        self.gridSpinBox.setObjectName(_fromUtf8("gridSpinBox"))
+        self.formLayout.setWidget(9, QtGui.QFormLayout.FieldRole, self.gridSpinBox)
+        self.snapLabel = QtGui.QLabel(CartogramDialog)
+        self.snapLabel.setObjectName(_fromUtf8("snapLabel"))
+        self.formLayout.setWidget(10, QtGui.QFormLayout.LabelRole, self.snapLabel)
+        self.snapSpinBox = QtGui.QDoubleSpinBox(CartogramDialog)
+        self.snapSpinBox.setDecimals(3)
+        self.snapSpinBox.setMaximum(1000.0)
+        self.snapSpinBox.setSingleStep(0.01)
+        self.snapSpinBox.setProperty("value", 0.0)
+        self.snapSpinBox.setObjectName(_fromUtf8("snapSpinBox"))
+        self.formLayout.setWidget(10, QtGui.QFormLayout.FieldRole, self.snapSpinBox)
+        self.coarseLabel = QtGui.QLabel(CartogramDialog)
+        self.coarseLabel.setObjectName(_fromUtf8("coarseLabel"))
+        self.formLayout.setWidget(11, QtGui.QFormLayout.LabelRole, self.coarseLabel)
+        self.coarseSpinBox = QtGui.QSpinBox(CartogramDialog)
+        self.coarseSpinBox.setMaximum(100000000)
+        self.coarseSpinBox.setSingleStep(10000)
+        self.coarseSpinBox.setProperty("value", 0)
+        self.coarseSpinBox.setObjectName(_fromUtf8("coarseSpinBox"))
+        self.formLayout.setWidget(11, QtGui.QFormLayout.FieldRole, self.coarseSpinBox)
+        self.checkpointLabel = QtGui.QLabel(CartogramDialog)
+        self.checkpointLabel.setObjectName(_fromUtf8("checkpointLabel"))
+        self.formLayout.setWidget(12, QtGui.QFormLayout.LabelRole, self.checkpointLabel)
+        self.checkpointSpinBox = QtGui.QSpinBox(CartogramDialog)
+        self.checkpointSpinBox.setMaximum(1000)
+        self.checkpointSpinBox.setProperty("value", 1)
+        self.checkpointSpinBox.setObjectName(_fromUtf8("checkpointSpinBox"))
+        self.formLayout.setWidget(12, QtGui.QFormLayout.FieldRole, self.checkpointSpinBox)
+        self.exportFormatLabel = QtGui.QLabel(CartogramDialog)
+        self.exportFormatLabel.setObjectName(_fromUtf8("exportFormatLabel"))
+        self.formLayout.setWidget(13, QtGui.QFormLayout.LabelRole, self.exportFormatLabel)
+        self.exportFormatCombo = QtGui.QComboBox(CartogramDialog)
+        self.exportFormatCombo.setObjectName(_fromUtf8("exportFormatCombo"))
+        self.formLayout.setWidget(13, QtGui.QFormLayout.FieldRole, self.exportFormatCombo)
+        self.precisionLabel = QtGui.QLabel(CartogramDialog)
+        self.precisionLabel.setObjectName(_fromUtf8("precisionLabel"))
+        self.formLayout.setWidget(14, QtGui.QFormLayout.LabelRole, self.precisionLabel)
+        self.precisionSpinBox = QtGui.QSpinBox(CartogramDialog)
+        self.precisionSpinBox.setMinimum(-1)
+        self.precisionSpinBox.setMaximum(15)
+        self.precisionSpinBox.setProperty("value", -1)
+        self.precisionSpinBox.setObjectName(_fromUtf8("precisionSpinBox"))
+        self.formLayout.setWidget(14, QtGui.QFormLayout.FieldRole, self.precisionSpinBox)
+        self.copyAttributesCheckBox = QtGui.QCheckBox(CartogramDialog)
+        self.copyAttributesCheckBox.setChecked(True)
+        self.copyAttributesCheckBox.setObjectName(_fromUtf8("copyAttributesCheckBox"))
+        self.formLayout.setWidget(15, QtGui.QFormLayout.SpanningRole, self.copyAttributesCheckBox)
+        self.streamCheckBox = QtGui.QCheckBox(CartogramDialog)
+        self.streamCheckBox.setChecked(False)
+        self.streamCheckBox.setObjectName(_fromUtf8("streamCheckBox"))
+        self.formLayout.setWidget(16, QtGui.QFormLayout.SpanningRole, self.streamCheckBox)
+        self.warmStartCheckBox = QtGui.QCheckBox(CartogramDialog)
+        self.warmStartCheckBox.setChecked(False)
+        self.warmStartCheckBox.setObjectName(_fromUtf8("warmStartCheckBox"))
+        self.formLayout.setWidget(17, QtGui.QFormLayout.SpanningRole, self.warmStartCheckBox)
+        self.previewCheckBox = QtGui.QCheckBox(CartogramDialog)
+        self.previewCheckBox.setChecked(False)
+        self.previewCheckBox.setObjectName(_fromUtf8("previewCheckBox"))
+        self.formLayout.setWidget(18, QtGui.QFormLayout.SpanningRole, self.previewCheckBox)
         self.buttonBox = QtGui.QDialogButtonBox(CartogramDialog)
         self.buttonBox.setOrientation(QtCore.Qt.Horizontal)
         self.buttonBox.setStandardButtons(QtGui.QDialogButtonBox.Cancel|QtGui.QDialogButtonBox.Ok)
         self.buttonBox.setObjectName(_fromUtf8("buttonBox"))
-        self.formLayout.setWidget(5, QtGui.QFormLayout.SpanningRole, self.buttonBox)
+        self.formLayout.setWidget(19, QtGui.QFormLayout.SpanningRole, self.buttonBox)
 
         self.retranslateUi(CartogramDialog)
         QtCore.QObject.connect(self.buttonBox, QtCore.SIGNAL(_fromUtf8("rejected()")), CartogramDialog.reject)
@@ -64,13 +172,43 @@ class Ui_CartogramDialog(object):
         QtCore.QMetaObject.connectSlotsByName(CartogramDialog)
         CartogramDialog.setTabOrder(self.sourceLayerCombo, self.sourceFieldCombo)
         CartogramDialog.setTabOrder(self.sourceFieldCombo, self.iterationsSpinBox)
-        CartogramDialog.setTabOrder(self.iterationsSpinBox, self.buttonBox)
+        CartogramDialog.setTabOrder(self.iterationsSpinBox, self.meanErrorSpinBox)
+        CartogramDialog.setTabOrder(self.meanErrorSpinBox, self.maxErrorSpinBox)
+        CartogramDialog.setTabOrder(self.maxErrorSpinBox, self.thetaSpinBox)
+        CartogramDialog.setTabOrder(self.thetaSpinBox, self.toleranceSpinBox)
+        CartogramDialog.setTabOrder(self.toleranceSpinBox, self.gridSpinBox)
+        CartogramDialog.setTabOrder(self.gridSpinBox, self.snapSpinBox)
+        CartogramDialog.setTabOrder(self.snapSpinBox, self.coarseSpinBox)
+        CartogramDialog.setTabOrder(self.coarseSpinBox, self.checkpointSpinBox)
+        CartogramDialog.setTabOrder(self.checkpointSpinBox, self.exportFormatCombo)
+        CartogramDialog.setTabOrder(self.exportFormatCombo, self.precisionSpinBox)
+        CartogramDialog.setTabOrder(self.precisionSpinBox, self.copyAttributesCheckBox)
+        CartogramDialog.setTabOrder(self.copyAttributesCheckBox, self.streamCheckBox)
+        CartogramDialog.setTabOrder(self.streamCheckBox, self.warmStartCheckBox)
+        CartogramDialog.setTabOrder(self.warmStartCheckBox, self.previewCheckBox)
+        CartogramDialog.setTabOrder(self.previewCheckBox, self.buttonBox)
 
     def retranslateUi(self, CartogramDialog):
         CartogramDialog.setWindowTitle(_translate("CartogramDialog", "Cartogram", None))
         self.sourceLayerLabel.setText(_translate("CartogramDialog", "Input layer:", None))
         self.sourceFieldLabel.setText(_translate("CartogramDialog", "Area field:", None))
         self.iterationsLabel.setText(_translate("CartogramDialog", "Number of iterations to perform:", None))
+        self.meanErrorLabel.setText(_translate("CartogramDialog", "Stop at mean size error (%, 0 = off):", None))
+        self.maxErrorLabel.setText(_translate("CartogramDialog", "Stop at max size error (%, 0 = off):", None))
+        self.thetaLabel.setText(_translate("CartogramDialog", "Approximation (theta, 0 = exact):", None))
+        self.toleranceLabel.setText(_translate("CartogramDialog", "Displacement tolerance (m, 0 = exact):", None))
+        self.gridLabel.setText(_translate("CartogramDialog", "Displacement grid cell size (m, 0 = exact):", None))
+        self.snapLabel.setText(_translate("CartogramDialog", "Snap vertices to a grid of (m):", None))
+        self.coarseLabel.setText(_translate("CartogramDialog", "Coarse vertex budget (0 = off):", None))
+        self.checkpointLabel.setText(_translate("CartogramDialog", "Save a checkpoint every (iterations):", None))
+        self.exportFormatLabel.setText(_translate("CartogramDialog", "Export format:", None))
+        self.precisionLabel.setText(_translate("CartogramDialog", "Coordinate precision (decimals):", None))
+        self.checkpointSpinBox.setSpecialValueText(_translate("CartogramDialog", "Off", None))
+        self.precisionSpinBox.setSpecialValueText(_translate("CartogramDialog", "Full", None))
+        self.copyAttributesCheckBox.setText(_translate("CartogramDialog", "Copy all attributes to the cartogram layer", None))
+        self.streamCheckBox.setText(_translate("CartogramDialog", "Stream large layers to the export file", None))
+        self.warmStartCheckBox.setText(_translate("CartogramDialog", "Start each animation frame from the previous one", None))
+        self.previewCheckBox.setText(_translate("CartogramDialog", "Preview intermediate iterations", None))
 
 from qgis import gui
 
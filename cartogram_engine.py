@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+
+"""Vectorized implementation of the Dougenik et al. force field."""
+
+import math
+import time
+
+import numpy
+
+import cartogram_kernel
+
+# maximum number of vertex/feature pairs evaluated in a single batch, this
+# keeps the temporary arrays of a batch at a few tens of megabytes
+BLOCK_SIZE = 1 << 20
+
+# maximum deviation from the per-point reference implementation, relative to
+# the largest displacement in the sample
+TOLERANCE = 1e-9
+
+# implementations of the force kernel: vectorized NumPy, or compiled by Numba
+BACKENDS = ('numpy', 'numba')
+
+
+def feature_arrays(meta_features):
+    """Return the arrays of a CartogramFeatures store the force field needs.
+
+    Returns center_x, center_y, mass and radius of the features with a mass.
+    """
+
+    # features without any mass do not exert any force on the vertices
+    return meta_features.active().force_arrays()
+
+
+def flatten_rings(rings):
+    """Flatten a list of rings into an (N, 2) array and an offset array.
+
+    The vertices of ring i are stored in coords[offsets[i]:offsets[i + 1]].
+    """
+
+    offsets = numpy.zeros(len(rings) + 1, numpy.int64)
+    offsets[1:] = numpy.cumsum([len(ring) for ring in rings])
+
+    coords = numpy.empty((offsets[-1], 2), numpy.float64)
+    for i, ring in enumerate(rings):
+        coords[offsets[i]:offsets[i + 1]] = ring
+
+    return (coords, offsets)
+
+
+def force(distance, mass, radius):
+    """Calculate the force per unit of distance exerted on each vertex.
+
+    All arguments are broadcast against each other, the result multiplied by
+    the offset of a vertex from a centroid gives the displacement of the
+    vertex (before applying the force reduction factor).
+    """
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        # points far away from the centroid of a polygon are pushed by the
+        # mass of the polygon scaled by the inverse distance; points close to
+        # the centroid are pushed by a cubic which is zero at the centroid
+        ratio = distance / radius
+        result = numpy.where(distance > radius,
+            mass * radius / distance,
+            mass * ratio ** 2 * (4 - 3 * ratio))
+        result /= distance
+
+    # a vertex located exactly on a centroid is not moved by that centroid
+    result[distance == 0] = 0
+
+    return result
+
+
+def available_backends():
+    """Return the backends which can be used on this installation."""
+    return [backend for backend in BACKENDS
+        if backend != 'numba' or cartogram_kernel.numba is not None]
+
+
+def default_backend():
+    """Return the fastest available backend."""
+    return available_backends()[-1]
+
+
+def check_backend(backend):
+    """Return backend, or the default one for None, if it can be used."""
+
+    if backend is None:
+        return default_backend()
+    if backend not in BACKENDS:
+        raise ValueError(u'Unknown backend "{}", use one of {}.'.format(
+            backend, u', '.join(BACKENDS)))
+    if backend not in available_backends():
+        raise ValueError(u'The {} backend is not available, it needs the '
+            u'{} package.'.format(backend, backend))
+
+    return backend
+
+
+def displacement(coords, center_x, center_y, mass, radius,
+    force_reduction_factor, block_size=BLOCK_SIZE, backend='numpy'):
+    """Compute the displacement of each vertex caused by all features.
+
+    With the numpy backend, the N x M vertex/feature interactions are
+    evaluated in batches of at most block_size pairs to keep memory usage
+    bounded. The numba backend needs no temporary arrays at all, see
+    cartogram_kernel.
+    """
+
+    result = numpy.zeros((len(coords), 2), numpy.float64)
+
+    feature_count = len(center_x)
+    if feature_count == 0:
+        return result
+
+    if backend == 'numba':
+        cartogram_kernel.displacement_kernel(
+            numpy.ascontiguousarray(coords, numpy.float64), center_x,
+            center_y, mass, radius, force_reduction_factor, result)
+        return result
+
+    rows = max(1, block_size // feature_count)
+
+    for start in range(0, len(coords), rows):
+        block = coords[start:start + rows]
+
+        dx = block[:, 0, numpy.newaxis] - center_x
+        dy = block[:, 1, numpy.newaxis] - center_y
+
+        block_force = force(numpy.hypot(dx, dy), mass, radius)
+
+        result[start:start + rows, 0] = numpy.einsum('ij,ij->i', dx,
+            block_force)
+        result[start:start + rows, 1] = numpy.einsum('ij,ij->i', dy,
+            block_force)
+
+    result *= force_reduction_factor
+
+    return result
+
+
+class ForceField(object):
+    """The exact force field exerted by a set of features.
+
+    Approximations of the field subclass this and override displacement().
+    backend selects the implementation of the force kernel (one of
+    BACKENDS), by default the fastest one available.
+    """
+
+    def __init__(self, center_x, center_y, mass, radius,
+        block_size=BLOCK_SIZE, backend=None):
+        """Constructor."""
+
+        self.center_x = center_x
+        self.center_y = center_y
+        self.mass = mass
+        self.radius = radius
+        self.block_size = block_size
+        self.backend = check_backend(backend)
+
+    def displacement(self, coords, force_reduction_factor, segments=None):
+        """Compute the displacement of each vertex of an (N, 2) array.
+
+        segments optionally holds the offsets of the rings in coords, which
+        approximations may use to group nearby vertices.
+        """
+        return displacement(coords, self.center_x, self.center_y, self.mass,
+            self.radius, force_reduction_factor, self.block_size,
+            self.backend)
+
+    def transform(self, coords, force_reduction_factor, segments=None):
+        """Return a displaced copy of an (N, 2) coordinate array."""
+        return coords + self.displacement(coords, force_reduction_factor,
+            segments)
+
+    def close(self):
+        """Release the resources held by the field, if any."""
+        pass
+
+
+def reference_displacement(x, y, meta_features, force_reduction_factor):
+    """Compute the displacement of a single point one feature at a time.
+
+    This is a direct transcription of the per-point formula and is only used
+    to verify the vectorized implementation.
+    """
+
+    dx_total = dy_total = 0.0
+
+    for feature in meta_features:
+        if feature.mass == 0:
+            continue
+
+        dx = x - feature.center_x
+        dy = y - feature.center_y
+        distance = math.sqrt(dx ** 2 + dy ** 2)
+        if distance == 0:
+            continue
+
+        if distance > feature.radius:
+            feature_force = feature.mass * feature.radius / distance
+        else:
+            ratio = distance / feature.radius
+            feature_force = feature.mass * (ratio ** 2) * (4 - (3 * ratio))
+        feature_force = feature_force * force_reduction_factor / distance
+
+        dx_total += dx * feature_force
+        dy_total += dy * feature_force
+
+    return (dx_total, dy_total)
+
+
+def max_deviation(coords, meta_features, force_reduction_factor,
+    sample_size=1000, block_size=BLOCK_SIZE, backend='numpy'):
+    """Compare a backend of the force kernel against the per-point formula.
+
+    Returns the largest deviation found in a sample of the vertices, relative
+    to the largest displacement in that sample.
+    """
+
+    if len(coords) == 0:
+        return 0.0
+
+    step = max(1, len(coords) // sample_size)
+    sample = coords[::step]
+
+    (center_x, center_y, mass, radius) = feature_arrays(meta_features)
+    vectorized = displacement(sample, center_x, center_y, mass, radius,
+        force_reduction_factor, block_size, backend)
+    reference = numpy.array([reference_displacement(x, y, meta_features,
+        force_reduction_factor) for (x, y) in sample])
+
+    scale = numpy.abs(reference).max()
+    if scale == 0:
+        return numpy.abs(vectorized).max()
+
+    return numpy.abs(vectorized - reference).max() / scale
+
+
+def error_report(field, coords, force_reduction_factor, sample_size=1000):
+    """Compare an approximate force field against the exact one.
+
+    A sample of the vertices is displaced by both fields. The returned dict
+    holds the maximum and mean absolute error, the mean displacement for
+    scale, and the time both fields took for the sample.
+    """
+
+    step = max(1, len(coords) // sample_size)
+    sample = numpy.array(coords[::step])
+
+    exact_field = ForceField(field.center_x, field.center_y, field.mass,
+        field.radius, field.block_size, field.backend)
+
+    start = time.time()
+    exact = exact_field.displacement(sample, force_reduction_factor)
+    exact_time = time.time() - start
+
+    start = time.time()
+    approximate = field.displacement(sample, force_reduction_factor)
+    approximate_time = time.time() - start
+
+    error = numpy.hypot(*(approximate - exact).T)
+    magnitude = numpy.hypot(*exact.T)
+
+    return {
+        'sample_size': len(sample),
+        'max_error': float(error.max()) if len(error) else 0.0,
+        'mean_error': float(error.mean()) if len(error) else 0.0,
+        'mean_displacement':
+            float(magnitude.mean()) if len(magnitude) else 0.0,
+        'exact_time': exact_time,
+        'approximate_time': approximate_time,
+    }
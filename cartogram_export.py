@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+"""Export of transformed features straight from a coordinate buffer."""
+
+from qgis.core import (QGis, QgsFeature, QgsGeometry, QgsPoint,
+    QgsVectorFileWriter)
+
+from collections import OrderedDict
+
+import os
+
+import numpy
+
+# OGR driver names of the supported formats, with their display names and
+# file extensions
+FORMATS = OrderedDict([
+    ('GPKG', (u'GeoPackage', '.gpkg')),
+    ('FlatGeobuf', (u'FlatGeobuf', '.fgb')),
+    ('GeoJSON', (u'GeoJSON', '.geojson')),
+    ('ESRI Shapefile', (u'ESRI Shapefile', '.shp')),
+])
+
+
+def available_formats():
+    """Return the entries of FORMATS whose OGR driver is installed."""
+
+    drivers = set(QgsVectorFileWriter.ogrDriverList().values())
+
+    return OrderedDict((driver, format) for (driver, format)
+        in FORMATS.items() if driver in drivers)
+
+
+def export_path(directory, name, driver):
+    """Return the path of an export file with the extension of its format."""
+    return os.path.join(directory, name + FORMATS[driver][1])
+
+
+class FeatureExporter(object):
+    """Writes features one at a time to a new vector file.
+
+    The geometries are built from the rings of a coordinate buffer, without
+    going through a layer, so that the features never have to be held in
+    memory. With a precision, the coordinates are rounded to that many
+    decimals. An existing file at the path is replaced.
+    """
+
+    def __init__(self, path, driver, fields, crs, precision=None):
+        """Constructor."""
+
+        self.path = path
+        self.driver = driver
+
+        layer_options = []
+        if driver == 'GeoJSON' and precision is not None:
+            layer_options.append('COORDINATE_PRECISION={}'.format(precision))
+
+        if os.path.exists(path):
+            if driver == 'ESRI Shapefile':
+                QgsVectorFileWriter.deleteShapeFile(path)
+            else:
+                os.remove(path)
+
+        self.fields = fields
+        self.precision = precision
+        self.writer = QgsVectorFileWriter(path, 'utf-8', fields,
+            QGis.WKBMultiPolygon, crs, driver, [], layer_options)
+        if self.writer.hasError() != QgsVectorFileWriter.NoError:
+            raise IOError(self.writer.errorMessage())
+
+    def add(self, polygons, attributes):
+        """Write a feature given as a list of lists of (N, 2) rings."""
+
+        if self.precision is not None:
+            polygons = [[numpy.round(ring, self.precision) for ring in polygon]
+                for polygon in polygons]
+
+        feature = QgsFeature(self.fields)
+        feature.setAttributes(attributes)
+        feature.setGeometry(QgsGeometry.fromMultiPolygon([[[QgsPoint(x, y)
+            for (x, y) in ring] for ring in polygon] for polygon in polygons]))
+
+        if not self.writer.addFeature(feature):
+            raise IOError(self.writer.errorMessage())
+
+    def close(self):
+        """Flush and close the file."""
+
+        # the file is only complete once the writer has been deleted
+        del self.writer
+        self.writer = None
+
+    def discard(self):
+        """Close and delete an incomplete file."""
+
+        self.close()
+        if self.driver == 'ESRI Shapefile':
+            QgsVectorFileWriter.deleteShapeFile(self.path)
+        elif os.path.exists(self.path):
+            os.remove(self.path)
@@ -1,10 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""Array-backed storage of the calculated values of the features."""
+
+import numbers
+
+import numpy
+
+# the calculated values stored for each feature, in the order of the rows of
+# CartogramFeatures.data
+COLUMNS = ('center_x', 'center_y', 'value', 'area', 'mass', 'radius')
+
+
+def column(row):
+    """Property which reads and writes one row of the data array."""
+
+    def get(self):
+        return self.data[row]
+
+    def set(self, values):
+        self.data[row] = values
+
+    return property(get, set)
+
+
+def item(row):
+    """Property which reads and writes one value of a feature view."""
+
+    def get(self):
+        return self.features.data[row, self.index]
+
+    def set(self, value):
+        self.features.data[row, self.index] = value
+
+    return property(get, set)
+
+
+class CartogramFeatures(object):
+    """Stores various calculated values for a set of features.
+
+    The values are kept in a single (6, N) float64 array with one contiguous
+    row per column, which pickles as one buffer and which the vectorized force
+    field reads without any copying. Indexing with an integer returns a
+    CartogramFeature view of a single feature, indexing with a slice, mask or
+    index array a new store with the selected features.
+    """
+
+    def __init__(self, count=0, data=None):
+        """Constructor.
+
+        Creates a store of count features with all values set to -1, or
+        wraps an existing data array.
+        """
+        if data is None:
+            data = numpy.full((len(COLUMNS), count), -1, numpy.float64)
+        self.data = data
+
+    center_x = column(0)
+    center_y = column(1)
+    value = column(2)
+    area = column(3)
+    mass = column(4)
+    radius = column(5)
+
+    def __len__(self):
+        return self.data.shape[1]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield CartogramFeature(self, index)
+
+    def __getitem__(self, index):
+        if isinstance(index, (numbers.Integral, numpy.integer)):
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError(u'feature index out of range')
+            return CartogramFeature(self, index)
+
+        return CartogramFeatures(data=numpy.ascontiguousarray(
+            self.data[:, index]))
+
+    def active(self):
+        """Return the features which exert a force, those with a mass."""
+        return self[self.mass != 0]
+
+    def force_arrays(self):
+        """Return the center_x, center_y, mass and radius rows."""
+        return (self.center_x, self.center_y, self.mass, self.radius)
+
+
 class CartogramFeature(object):
-    """Stores various calculated values for each feature."""
-
-    def __init__(self):
-        self.center_x = -1
-        self.center_y = -1
-        self.value = -1
-        self.area = -1
-        self.mass = -1
-        self.radius = -1
+    """View of the values of a single feature in a CartogramFeatures store."""
+
+    __slots__ = ('features', 'index')
+
+    def __init__(self, features, index):
+        self.features = features
+        self.index = index
+
+    center_x = item(0)
+    center_y = item(1)
+    value = item(2)
+    area = item(3)
+    mass = item(4)
+    radius = item(5)
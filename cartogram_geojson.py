@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""Reading and writing polygon layers as GeoJSON, without QGIS."""
+
+import io
+import json
+
+import numpy
+
+
+def read(path):
+    """Read a GeoJSON file and return its features as a FeatureCollection."""
+
+    with io.open(path, encoding='utf-8') as source:
+        collection = json.load(source)
+
+    if collection.get('type') == 'Feature':
+        collection = {'type': 'FeatureCollection', 'features': [collection]}
+    if collection.get('type') != 'FeatureCollection':
+        raise ValueError(u'{} is not a GeoJSON FeatureCollection.'.format(
+            path))
+
+    return collection
+
+
+def polygons(geometry):
+    """Return a (multi)polygon geometry as a list of lists of (x, y) rings.
+
+    Any z or m values are dropped, an empty or missing geometry results in an
+    empty list.
+    """
+
+    if geometry is None:
+        return []
+
+    if geometry['type'] == 'Polygon':
+        parts = [geometry['coordinates']]
+    elif geometry['type'] == 'MultiPolygon':
+        parts = geometry['coordinates']
+    else:
+        raise ValueError(u'Only polygon geometries are supported, not '
+            u'{}.'.format(geometry['type']))
+
+    return [[[(point[0], point[1]) for point in ring] for ring in polygon]
+        for polygon in parts]
+
+
+def value(feature, field_name):
+    """Return the value of a feature, None if it is missing."""
+
+    value = (feature.get('properties') or {}).get(field_name)
+    if value is None:
+        return None
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise ValueError(u'The value "{}" of the field "{}" is not a '
+            u'number.'.format(value, field_name))
+
+
+def geometry(coordinates, index, geometry_type=None, precision=None):
+    """Build the GeoJSON geometry of a feature of a coordinate buffer.
+
+    Single polygons are written as a Polygon, unless geometry_type (the type
+    of the source geometry) is MultiPolygon. Coordinates are rounded to
+    precision decimals, if given.
+    """
+
+    parts = []
+    for rings in coordinates.polygons(index):
+        if precision is not None:
+            rings = [numpy.round(ring, precision) for ring in rings]
+        parts.append([ring.tolist() for ring in rings])
+
+    if len(parts) == 0:
+        return None
+    if len(parts) == 1 and geometry_type != 'MultiPolygon':
+        return {'type': 'Polygon', 'coordinates': parts[0]}
+
+    return {'type': 'MultiPolygon', 'coordinates': parts}
+
+
+def write(path, collection, coordinates, precision=None):
+    """Write a FeatureCollection with the geometries of a coordinate buffer.
+
+    The features of the collection keep their properties, their geometries
+    are replaced by those of the corresponding feature in the buffer.
+    """
+
+    features = []
+    for (index, feature) in enumerate(collection['features']):
+        source = feature.get('geometry')
+        feature = dict(feature)
+        feature.pop('bbox', None)
+        feature['geometry'] = geometry(coordinates, index,
+            source['type'] if source else None, precision)
+        features.append(feature)
+
+    # the extent has changed, so any bounding boxes are dropped
+    collection = dict(collection, features=features)
+    collection.pop('bbox', None)
+
+    with open(path, 'w') as target:
+        json.dump(collection, target)
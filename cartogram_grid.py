@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+"""Displacement evaluated on a regular grid and interpolated in between."""
+
+from cartogram_engine import BLOCK_SIZE, ForceField
+
+import math
+import os
+import tempfile
+
+import numpy
+
+# upper limit of the number of nodes of a grid, which bounds its memory use
+# and the size of its file
+MAX_NODES = 1 << 22
+
+
+def grid_shape(extent, cell_size):
+    """Return the number of rows and columns of nodes covering an extent."""
+
+    (x_min, y_min, x_max, y_max) = extent
+    columns = int(math.ceil((x_max - x_min) / cell_size)) + 1
+    rows = int(math.ceil((y_max - y_min) / cell_size)) + 1
+
+    if rows * columns > MAX_NODES:
+        raise ValueError(u'A grid with a cell size of {:.6g} would have {} '
+            u'nodes, more than the {} allowed. Choose a larger cell '
+            u'size.'.format(cell_size, rows * columns, MAX_NODES))
+
+    return (rows, columns)
+
+
+def grid_nodes(x_min, y_min, cell_size, rows, columns):
+    """Return the coordinates of the nodes of a grid, row by row."""
+
+    (y, x) = numpy.mgrid[0:rows, 0:columns]
+
+    return numpy.column_stack((x_min + x.ravel() * cell_size,
+        y_min + y.ravel() * cell_size))
+
+
+class DisplacementGrid(object):
+    """A displacement given at the nodes of a regular grid.
+
+    Node (row, column) lies at (x_min + column * cell_size, y_min + row *
+    cell_size), and values is a (rows, columns, 2) array with its
+    displacement. In between the nodes the displacement is interpolated
+    bilinearly, outside the grid the nearest edge is used.
+    """
+
+    def __init__(self, x_min, y_min, cell_size, values):
+        """Constructor."""
+
+        self.x_min = x_min
+        self.y_min = y_min
+        self.cell_size = cell_size
+        self.values = values
+
+    @classmethod
+    def load(cls, path):
+        """Read a grid written by save()."""
+
+        with numpy.load(path) as archive:
+            (x_min, y_min, cell_size) = archive['origin']
+            return cls(float(x_min), float(y_min), float(cell_size),
+                archive['values'])
+
+    def save(self, path):
+        """Write the grid to a NumPy .npz archive."""
+
+        # numpy.savez would append .npz to any other file name
+        with open(path, 'wb') as target:
+            numpy.savez(target, origin=numpy.array([self.x_min, self.y_min,
+                self.cell_size]), values=self.values)
+
+    def extent(self):
+        """Return the extent covered by the nodes."""
+
+        (rows, columns) = self.values.shape[:2]
+
+        return (self.x_min, self.y_min,
+            self.x_min + (columns - 1) * self.cell_size,
+            self.y_min + (rows - 1) * self.cell_size)
+
+    def contains(self, coords):
+        """Return a mask of the points of an (N, 2) array within the grid."""
+
+        (x_min, y_min, x_max, y_max) = self.extent()
+
+        return (coords[:, 0] >= x_min) & (coords[:, 0] <= x_max) & \
+            (coords[:, 1] >= y_min) & (coords[:, 1] <= y_max)
+
+    def interpolate(self, coords):
+        """Return the displacement at each point of an (N, 2) array."""
+
+        (rows, columns) = self.values.shape[:2]
+
+        u = numpy.clip((coords[:, 0] - self.x_min) / self.cell_size, 0,
+            columns - 1)
+        v = numpy.clip((coords[:, 1] - self.y_min) / self.cell_size, 0,
+            rows - 1)
+
+        # the last row and column interpolate within the cell before them
+        column = numpy.minimum(u.astype(numpy.int64), max(columns - 2, 0))
+        row = numpy.minimum(v.astype(numpy.int64), max(rows - 2, 0))
+        u = (u - column)[:, numpy.newaxis]
+        v = (v - row)[:, numpy.newaxis]
+        next_column = numpy.minimum(column + 1, columns - 1)
+        next_row = numpy.minimum(row + 1, rows - 1)
+
+        values = self.values
+        return (values[row, column] * (1 - u) * (1 - v) +
+            values[row, next_column] * u * (1 - v) +
+            values[next_row, column] * (1 - u) * v +
+            values[next_row, next_column] * u * v)
+
+    def transform(self, coords):
+        """Return a displaced copy of an (N, 2) coordinate array."""
+        return coords + self.interpolate(coords)
+
+
+class GridField(ForceField):
+    """Force field evaluated at the nodes of a regular grid only.
+
+    The field of all features is computed exactly at the nodes of a grid
+    with the given cell size (in map units) covering extent, a tuple of
+    (x_min, y_min, x_max, y_max), and interpolated bilinearly at the
+    vertices. An iteration then costs nodes x features plus vertices instead
+    of vertices x features. Vertices outside of the grid are evaluated
+    exactly.
+
+    The grid is kept in a temporary, memory-mapped file in directory (by
+    default the system's temporary directory). evaluate_nodes()
+    fills in a range of its nodes, so that the worker processes of a pool
+    can evaluate them in parallel, and a pickled field only carries the
+    path, so that every process maps the same grid instead of receiving a
+    copy of it. The copies in other processes map it read-only, only
+    evaluate_nodes() writes to its own range of nodes. close() deletes the
+    file, so it must only be called once no other process uses the field.
+    """
+
+    def __init__(self, center_x, center_y, mass, radius, extent, cell_size,
+        directory=None, block_size=BLOCK_SIZE, backend=None):
+        """Constructor."""
+
+        ForceField.__init__(self, center_x, center_y, mass, radius,
+            block_size, backend)
+
+        (self.rows, self.columns) = grid_shape(extent, cell_size)
+        (self.x_min, self.y_min) = extent[:2]
+        self.cell_size = cell_size
+
+        (handle, self.path) = tempfile.mkstemp(suffix='.grid', dir=directory)
+        os.close(handle)
+        self.grid = self.map('w+')
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['grid']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.grid = self.map('r')
+
+    def map(self, mode):
+        """Map the grid file as a DisplacementGrid."""
+        return DisplacementGrid(self.x_min, self.y_min, self.cell_size,
+            numpy.memmap(self.path, numpy.float64, mode,
+                shape=(self.rows, self.columns, 2)))
+
+    def node_count(self):
+        """Return the number of nodes of the grid."""
+        return self.rows * self.columns
+
+    def evaluate_nodes(self, start, end):
+        """Compute the field at a range of the nodes, numbered row by row."""
+
+        index = numpy.arange(start, end)
+        nodes = numpy.column_stack((
+            self.x_min + (index % self.columns) * self.cell_size,
+            self.y_min + (index // self.columns) * self.cell_size))
+
+        # only the range is mapped writable, at two float64 (16 bytes) per
+        # node
+        values = numpy.memmap(self.path, numpy.float64, 'r+',
+            offset=16 * start, shape=(end - start, 2))
+
+        # the displacement is proportional to the force reduction factor, so
+        # the nodes are evaluated once for a factor of one
+        values[:] = ForceField.displacement(self, nodes, 1.0)
+        del values
+
+    def close(self):
+        """Release the mapping and delete the grid file."""
+
+        self.grid = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def displacement(self, coords, force_reduction_factor, segments=None):
+        """Compute the interpolated displacement of each vertex."""
+
+        inside = self.grid.contains(coords)
+        if inside.all():
+            return self.grid.interpolate(coords) * force_reduction_factor
+
+        result = numpy.empty((len(coords), 2), numpy.float64)
+        result[inside] = self.grid.interpolate(coords[inside]) * \
+            force_reduction_factor
+        result[~inside] = ForceField.displacement(self, coords[~inside],
+            force_reduction_factor)
+
+        return result
+
+
+class GridTracer(object):
+    """Follows the nodes of a grid through the iterations of a solver.
+
+    The nodes cover extent with the given cell size (in map units), and are
+    displaced by the same force fields as the vertices. Their total
+    displacement, as a DisplacementGrid, transforms other layers the same
+    way as the cartogram.
+    """
+
+    def __init__(self, extent, cell_size):
+        """Constructor."""
+
+        (self.x_min, self.y_min) = extent[:2]
+        self.cell_size = cell_size
+        (self.rows, self.columns) = grid_shape(extent, cell_size)
+        self.nodes = grid_nodes(self.x_min, self.y_min, cell_size, self.rows,
+            self.columns)
+        self.points = self.nodes.copy()
+
+    def transform(self, field, force_reduction_factor):
+        """Displace the nodes by a force field."""
+        self.points = field.transform(self.points, force_reduction_factor)
+
+    def grid(self):
+        """Return the total displacement of the nodes so far."""
+        return DisplacementGrid(self.x_min, self.y_min, self.cell_size,
+            (self.points - self.nodes).reshape(self.rows, self.columns, 2))
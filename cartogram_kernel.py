@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+"""Force kernel compiled with Numba, if it is installed.
+
+The kernel computes the displacement of cartogram_engine.displacement in a
+single loop per vertex: the distance, the near and far branches of the force
+and the sums over all features are fused, so that no temporary arrays are
+needed, and the vertices are spread over all cores with prange. It performs
+the operations of cartogram_engine.reference_displacement in the same order,
+so its results are identical to those of the per-point reference. Without
+Numba the kernel is plain (and slow) Python, which is only useful to check
+it.
+"""
+
+import math
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+if numba is not None:
+    prange = numba.prange
+else:
+    prange = range
+
+
+def set_threads(count):
+    """Limit the number of threads of the compiled kernel.
+
+    Worker processes which transform their share of the vertices in parallel
+    to each other use a single thread each. Does nothing without Numba, or
+    with a version too old to change the number of threads.
+    """
+    if numba is not None and hasattr(numba, 'set_num_threads'):
+        numba.set_num_threads(min(count, numba.config.NUMBA_NUM_THREADS))
+
+
+def displacement_kernel(coords, center_x, center_y, mass, radius,
+    force_reduction_factor, result):
+    """Add up the displacement of each vertex of coords in result."""
+
+    for i in prange(coords.shape[0]):
+        x = coords[i, 0]
+        y = coords[i, 1]
+        dx_total = 0.0
+        dy_total = 0.0
+
+        for j in range(center_x.shape[0]):
+            dx = x - center_x[j]
+            dy = y - center_y[j]
+            distance = math.sqrt(dx ** 2 + dy ** 2)
+
+            # a vertex located exactly on a centroid is not moved by it
+            if distance == 0:
+                continue
+
+            if distance > radius[j]:
+                feature_force = mass[j] * radius[j] / distance
+            else:
+                ratio = distance / radius[j]
+                feature_force = mass[j] * (ratio ** 2) * (4 - (3 * ratio))
+            feature_force = feature_force * force_reduction_factor / distance
+
+            dx_total += dx * feature_force
+            dy_total += dy * feature_force
+
+        result[i, 0] = dx_total
+        result[i, 1] = dy_total
+
+
+if numba is not None:
+    displacement_kernel = numba.njit(parallel=True, cache=True)(
+        displacement_kernel)
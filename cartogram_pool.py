@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+
+"""Long-lived pool of processes which transform the coordinate buffer."""
+
+from cartogram_coordinates import CoordinateBuffer
+from cartogram_kernel import set_threads
+from cartogram_stats import cpu_time
+
+import multiprocessing
+import time
+
+import numpy
+
+# number of tasks queued per worker process, enough to keep every process busy
+# while the results of the previous tasks are collected
+TASKS_PER_PROCESS = 2
+
+# seconds to wait for a task to finish before checking the worker processes
+POLL_INTERVAL = 0.5
+
+
+# coordinate buffer mapped by the current worker process, set up once by
+# initialize() when the process starts
+coordinates = None
+
+
+def initialize(spec):
+    """Map the coordinate buffer when a worker process starts."""
+    global coordinates
+    coordinates = CoordinateBuffer(*spec)
+
+    # the processes already work in parallel to each other
+    set_threads(1)
+
+
+def transform_range(coordinates, start, end, field, force_reduction_factor):
+    """Transform a range of unique vertices of a buffer in place.
+
+    The buffer is a shared mapping, so the other processes see the new
+    vertices right away; it is not flushed to disk.
+    """
+
+    vertices = coordinates.vertices
+    vertices[start:end] = field.transform(vertices[start:end],
+        force_reduction_factor, coordinates.segments(start, end))
+
+    return (start, end)
+
+
+def timed_transform(coordinates, start, end, field, force_reduction_factor):
+    """Transform a range of unique vertices of a buffer in place.
+
+    Returns the range and the wall clock and CPU time it took.
+    """
+
+    wall = time.time()
+    cpu = cpu_time()
+    transform_range(coordinates, start, end, field, force_reduction_factor)
+
+    return (start, end, time.time() - wall, cpu_time() - cpu)
+
+
+def transform(task):
+    """Transform a range of unique vertices, return the range and times."""
+    return timed_transform(coordinates, *task)
+
+
+def timed_evaluation(start, end, field):
+    """Evaluate a range of the nodes of a grid force field.
+
+    Returns the range and the wall clock and CPU time it took.
+    """
+
+    wall = time.time()
+    cpu = cpu_time()
+    field.evaluate_nodes(start, end)
+
+    return (start, end, time.time() - wall, cpu_time() - cpu)
+
+
+def evaluate(task):
+    """Evaluate a range of grid nodes, return range and times."""
+    return timed_evaluation(*task)
+
+
+def node_ranges(count, pieces):
+    """Split count grid nodes into at most pieces ranges of equal size."""
+
+    bounds = numpy.unique(numpy.linspace(0, count, pieces + 1).astype(
+        numpy.int64))
+
+    return [(int(start), int(end))
+        for (start, end) in zip(bounds[:-1], bounds[1:])]
+
+
+class ProcessPool(object):
+    """Worker processes whose tasks are tracked until their results arrive.
+
+    An exception raised by a task is raised in the caller, and a worker
+    process which exits unexpectedly (taking its task with it) raises a
+    RuntimeError instead of leaving the caller waiting forever.
+    """
+
+    def __init__(self, processes, initializer, arguments):
+        """Constructor."""
+
+        self.processes = processes or multiprocessing.cpu_count()
+
+        children = set(multiprocessing.active_children())
+        self.pool = multiprocessing.Pool(self.processes, initializer,
+            arguments)
+        self.workers = [process for process
+            in multiprocessing.active_children() if process not in children]
+
+    def run(self, function, tasks, queued, cancelled=None):
+        """Run function on each task, yielding the results as they arrive.
+
+        Tasks are started in order, with at most queued of them waiting or
+        running at a time. As soon as cancelled() returns True, no further
+        results are yielded and the running tasks are left to be
+        terminated. When the caller stops early for any other reason, no
+        further tasks are started and those already running are waited for.
+        """
+
+        cancelled = cancelled or (lambda: False)
+        queue = list(tasks)
+        pending = []
+
+        try:
+            while queue or pending:
+                if cancelled():
+                    return
+
+                while queue and len(pending) < queued:
+                    pending.append(self.pool.apply_async(function,
+                        (queue.pop(0),)))
+
+                finished = [result for result in pending if result.ready()]
+                if not finished:
+                    if not self.alive():
+                        raise RuntimeError(u'A worker process exited '
+                            u'unexpectedly.')
+                    pending[0].wait(POLL_INTERVAL)
+                    continue
+
+                for result in finished:
+                    pending.remove(result)
+                    yield result.get()
+        finally:
+            if not cancelled():
+                for result in pending:
+                    while not result.ready() and self.alive():
+                        result.wait(POLL_INTERVAL)
+
+    def alive(self):
+        """Return whether all worker processes are still running."""
+        return all(process.is_alive() for process in self.workers)
+
+    def close(self):
+        """Wait for the worker processes to exit."""
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        """Stop the worker processes immediately."""
+        self.pool.terminate()
+        self.pool.join()
+
+
+class TransformPool(ProcessPool):
+    """Worker processes which live for the duration of a cartogram job.
+
+    The processes are started and map the coordinate buffer once; each
+    iteration only sends them the force field (the feature arrays, possibly
+    arranged in a quadtree) and the force reduction factor along with the
+    vertex ranges to work on.
+
+    task_wall and task_cpu add up the time the tasks took in the worker
+    processes. Force fields passed to release() are closed once the
+    processes have exited, as the processes may still hold a copy of them.
+    """
+
+    def __init__(self, coordinates, processes=None):
+        """Constructor."""
+
+        ProcessPool.__init__(self, processes, initialize,
+            (coordinates.spec(),))
+
+        self.task_wall = self.task_cpu = 0.0
+        self.released = []
+
+    def transform(self, chunks, field, force_reduction_factor):
+        """Transform all chunks, yielding each (start, end) range when done.
+
+        The largest chunks are handed out first, and only a few tasks per
+        process are queued at a time, so that the processes finish at about
+        the same time. When the caller stops early, e.g. after a
+        cancellation, no further tasks are started and those already running
+        are waited for, so that none of them writes to the buffer
+        afterwards.
+        """
+        return self.run(transform, [(start, end, field,
+            force_reduction_factor) for (start, end) in chunks])
+
+    def evaluate(self, field):
+        """Evaluate the nodes of a GridField, yielding each (start, end)
+        range of nodes when done.
+
+        The nodes are written to the memory-mapped file of the field, and
+        the tasks are tracked like those of transform().
+        """
+        return self.run(evaluate, [(start, end, field) for (start, end)
+            in node_ranges(field.node_count(),
+                self.processes * TASKS_PER_PROCESS)])
+
+    def run(self, function, tasks):
+        """Run tasks which start with a (start, end) range, the largest first,
+        yielding each range when done."""
+
+        results = ProcessPool.run(self, function, sorted(tasks,
+            key=lambda task: task[1] - task[0], reverse=True),
+            self.processes * TASKS_PER_PROCESS)
+
+        try:
+            for (start, end, wall, cpu) in results:
+                self.task_wall += wall
+                self.task_cpu += cpu
+                yield (start, end)
+        finally:
+            results.close()
+
+    def release(self, field):
+        """Close a force field once the worker processes have exited."""
+        self.released.append(field)
+
+    def close(self):
+        """Wait for the worker processes to exit."""
+        ProcessPool.close(self)
+        self.close_released()
+
+    def terminate(self):
+        """Stop the worker processes immediately."""
+        ProcessPool.terminate(self)
+        self.close_released()
+
+    def close_released(self):
+        """Close the released force fields."""
+
+        for field in self.released:
+            field.close()
+        self.released = []
+
+
+class LocalPool(object):
+    """Transforms the coordinate buffer in the current process.
+
+    Has the same interface as TransformPool, for callers which run in a
+    worker process already (e.g. the frames of an animation) or have only a
+    single CPU to work with.
+    """
+
+    def __init__(self, coordinates):
+        """Constructor."""
+
+        self.coordinates = coordinates
+        self.task_wall = self.task_cpu = 0.0
+
+    def transform(self, chunks, field, force_reduction_factor):
+        """Transform all chunks, yielding each (start, end) range when done."""
+
+        for (start, end) in chunks:
+            (start, end, wall, cpu) = timed_transform(self.coordinates, start,
+                end, field, force_reduction_factor)
+            self.task_wall += wall
+            self.task_cpu += cpu
+            yield (start, end)
+
+    def evaluate(self, field):
+        """Evaluate the nodes of a GridField, yielding the range when done."""
+
+        (start, end, wall, cpu) = timed_evaluation(0, field.node_count(),
+            field)
+        self.task_wall += wall
+        self.task_cpu += cpu
+        yield (start, end)
+
+    def release(self, field):
+        """Close a force field, which no other process uses."""
+        field.close()
+
+    def close(self):
+        """Nothing to clean up."""
+        pass
+
+    def terminate(self):
+        """Nothing to clean up."""
+        pass
+
+
+def create_pool(coordinates, processes=None):
+    """Start a pool for the coordinate buffer, by default one process per CPU.
+
+    A single process transforms the buffer without starting a pool.
+    """
+
+    processes = processes or multiprocessing.cpu_count()
+    if processes > 1:
+        return TransformPool(coordinates, processes)
+
+    return LocalPool(coordinates)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+"""Barnes-Hut approximation of the force field."""
+
+from cartogram_engine import BLOCK_SIZE, ForceField, displacement
+
+import numpy
+
+# default accuracy parameter, smaller values are more accurate and slower; a
+# theta of zero always evaluates the exact force field
+DEFAULT_THETA = 0.5
+
+# maximum number of features in a leaf of the tree
+LEAF_SIZE = 16
+
+# the tree is not subdivided any further than this, which protects against
+# many features sharing (almost) the same centroid
+MAX_DEPTH = 32
+
+
+class QuadTreeNode(object):
+    """A node of the quadtree which summarises all features below it."""
+
+    def __init__(self, members, center_x, center_y, mass, radius, theta):
+        """Constructor."""
+
+        self.members = members
+        self.children = []
+
+        x = center_x[members]
+        y = center_y[members]
+
+        # geometric center of the node and the distance to its furthest member
+        self.x = (x.min() + x.max()) / 2
+        self.y = (y.min() + y.max()) / 2
+        offset = numpy.hypot(x - self.x, y - self.y)
+        self.extent = offset.max()
+
+        # a vertex further away than this is outside the radius of every
+        # member, so all members act on it with their far field force
+        reach = (offset + radius[members]).max()
+        if theta > 0:
+            self.threshold = max(2 * self.extent / theta, reach)
+        else:
+            self.threshold = numpy.inf
+
+        # the far field of a feature is proportional to mass * radius; members
+        # pushing and pulling are lumped into separate poles, each placed at
+        # the weighted mean of its members, so that mixed signs do not cancel
+        # out into a pole at a meaningless position
+        charge = mass[members] * radius[members]
+        self.poles = []
+        for group in (charge > 0, charge < 0):
+            if group.any():
+                total = charge[group].sum()
+                self.poles.append((total,
+                    (charge[group] * x[group]).sum() / total,
+                    (charge[group] * y[group]).sum() / total))
+
+    def far_displacement(self, points):
+        """Approximate the displacement of distant points by the poles."""
+
+        result = numpy.zeros((len(points), 2), numpy.float64)
+        for (charge, x, y) in self.poles:
+            dx = points[:, 0] - x
+            dy = points[:, 1] - y
+            scale = charge / (dx ** 2 + dy ** 2)
+            result[:, 0] += dx * scale
+            result[:, 1] += dy * scale
+
+        return result
+
+
+class QuadTree(ForceField):
+    """Force field approximated with a quadtree over the feature centroids.
+
+    Groups of features which are far away from a vertex, relative to the size
+    of the group, are replaced by their aggregated mass. The cost of an
+    iteration grows with V log F instead of V x F.
+    """
+
+    def __init__(self, center_x, center_y, mass, radius,
+        theta=DEFAULT_THETA, leaf_size=LEAF_SIZE, block_size=BLOCK_SIZE,
+        backend=None):
+        """Constructor."""
+
+        ForceField.__init__(self, center_x, center_y, mass, radius,
+            block_size, backend)
+
+        self.theta = theta
+        self.leaf_size = leaf_size
+
+        self.root = None
+        if len(center_x) > 0:
+            self.root = self.build(numpy.arange(len(center_x)), 0)
+
+    def build(self, members, depth):
+        """Recursively build the node containing the given features."""
+
+        node = QuadTreeNode(members, self.center_x, self.center_y, self.mass,
+            self.radius, self.theta)
+
+        if len(members) <= self.leaf_size or depth >= MAX_DEPTH \
+            or node.extent == 0:
+            return node
+
+        west = self.center_x[members] < node.x
+        south = self.center_y[members] < node.y
+        for quadrant in (west & south, west & ~south, ~west & south,
+            ~west & ~south):
+            if quadrant.any():
+                node.children.append(self.build(members[quadrant], depth + 1))
+
+        return node
+
+    def displacement(self, coords, force_reduction_factor, segments=None):
+        """Compute the approximate displacement of each vertex.
+
+        The tree is traversed once for all vertices: each node receives the
+        vertices which were too close to its parent to use the parent's poles.
+        """
+
+        result = numpy.zeros((len(coords), 2), numpy.float64)
+        if self.root is None:
+            return result
+
+        stack = [(self.root, numpy.arange(len(coords)))]
+        while stack:
+            (node, index) = stack.pop()
+            points = coords[index]
+
+            far = numpy.hypot(points[:, 0] - node.x,
+                points[:, 1] - node.y) > node.threshold
+            if far.any():
+                result[index[far]] += node.far_displacement(points[far])
+
+            near = ~far
+            if not near.any():
+                continue
+
+            if node.children:
+                stack.extend((child, index[near]) for child in node.children)
+            else:
+                members = node.members
+                result[index[near]] += displacement(points[near],
+                    self.center_x[members], self.center_y[members],
+                    self.mass[members], self.radius[members], 1.0,
+                    self.block_size, self.backend)
+
+        result *= force_reduction_factor
+
+        return result
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+"""Timing and profiling instrumentation of cartogram jobs."""
+
+import contextlib
+import cProfile
+import json
+import os
+import time
+
+
+def cpu_time():
+    """Return the CPU time (user and system) used by the current process."""
+    times = os.times()
+    return times[0] + times[1]
+
+
+class Stopwatch(object):
+    """Measures the wall clock and CPU time of named stages.
+
+    The times of a stage add up over all measurements, stages holds a dict
+    with the wall and cpu seconds of each one.
+    """
+
+    def __init__(self):
+        """Constructor."""
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def measure(self, stage):
+        """Add the time spent in the with block to the stage."""
+
+        wall = time.time()
+        cpu = cpu_time()
+        try:
+            yield
+        finally:
+            times = self.stages.setdefault(stage, {'wall': 0.0, 'cpu': 0.0})
+            times['wall'] += time.time() - wall
+            times['cpu'] += cpu_time() - cpu
+
+
+class JsonLog(object):
+    """Appends records to a file, one JSON object per line."""
+
+    def __init__(self, path):
+        """Constructor."""
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.path = path
+
+    def write(self, record):
+        """Append a record to the log."""
+        with open(self.path, 'a') as target:
+            target.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+@contextlib.contextmanager
+def profile(path=None):
+    """Profile the with block and dump the statistics to path, if given.
+
+    Only the current process is profiled, not the worker processes.
+    """
+
+    if path is None:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
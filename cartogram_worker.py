@@ -1,302 +1,633 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-from PyQt4.QtCore import pyqtSignal, QObject, QPyNullVariant
-from qgis.core import QgsDistanceArea, QgsGeometry, QgsPoint, QgsVectorFileWriter
+from PyQt4.QtCore import pyqtSignal, QObject, QPyNullVariant, QVariant
+from qgis.core import (QGis, QgsFeature, QgsFeatureRequest, QgsField,
+    QgsFields, QgsGeometry, QgsPoint, QgsVectorDataProvider)
 
-from cartogram_feature import CartogramFeature
+from cartogram_animation import FramePool
+from cartogram_coordinates import CoordinateBuffer
+from cartogram_core import CartogramSolver, prepare_values
+from cartogram_export import FeatureExporter
+from cartogram_pool import create_pool
+from cartogram_stats import JsonLog, Stopwatch
 
 import math
+import time
 import traceback
 
-import multiprocessing
-import Queue
+# number of geometries committed to the data provider at once
+WRITE_BATCH_SIZE = 10000
+
+# minimum number of seconds between two previews of intermediate iterations
+PREVIEW_INTERVAL = 1.0
 
 
 class CartogramWorker(QObject):
-    """Background worker which actually creates the cartogram."""
+    """Background worker which creates the cartogram of a QGIS layer.
+
+    The cartogram itself is computed by the QGIS-free CartogramSolver, the
+    worker reads the layer, writes the result back and relays feedback,
+    progress and cancellation through Qt signals.
+    """
 
     finished = pyqtSignal(object, int)
     error = pyqtSignal(Exception, basestring)
     progress = pyqtSignal(float)
     feedback = pyqtSignal(unicode)
+    statistics = pyqtSignal(object)
+    preview = pyqtSignal(int, object)
 
     forces=[]
 
-    def __init__(self, layer, field_name, iterations):
-        """Constructor."""
+    def __init__(self, layer, field_name, iterations, output_layer=None,
+        theta=0, tolerance=0, snap=0, target_mean_error=0,
+        target_max_error=0, cache=None, checkpoint_interval=1, log_path=None,
+        profile_iteration=0, profile_path=None, export_path=None,
+        export_driver='GPKG', precision=None, stream=False, backend=None,
+        preview_vertices=0, coarse_vertices=0, grid_size=0, grid_path=None):
+        """Constructor.
+
+        Without an output layer the geometries of the input layer are
+        replaced, so it should be a copy of the source layer. Otherwise the
+        input layer is only read, and the output layer (with an id and the
+        value field) is filled with the transformed features.
+
+        With an export_path, the transformed features are also written to a
+        file in the format of the OGR driver export_driver (see
+        cartogram_export.FORMATS), with the coordinates rounded to precision
+        decimals if given. The features come straight from the coordinate
+        buffer, one at a time.
+
+        With stream, the worker handles a layer which may not fit into
+        memory: the vertices are only held in a memory-mapped file, vertices
+        shared between rings are not merged, and the features (with an id
+        and the value field) are only written to the export file.
+
+        A theta greater than zero approximates the force field with a
+        Barnes-Hut quadtree, larger values are faster and less accurate.
+        Otherwise a tolerance (in metres) greater than zero evaluates features
+        which move a vertex by less than the tolerance only coarsely, or a
+        grid_size (in metres) greater than zero evaluates the field on a grid
+        with cells of that size only. With a grid_path, the total
+        displacement (in map units) is saved there, see CartogramSolver.
+        Vertices which round to the same node of a grid with a spacing of
+        snap (in metres) are merged.
+
+        With a target mean and/or max size error (in percent) greater than
+        zero, the worker stops as soon as the errors drop below the targets,
+        and iterations becomes the maximum number of iterations.
+
+        With a ResultCache, the worker continues from the latest checkpoint
+        of the same job, and stores a checkpoint every checkpoint_interval
+        iterations; an interval of zero turns the checkpoints off.
+
+        The timings of the stages of the job and of each iteration are
+        emitted as dicts through the statistics signal, and appended to the
+        JSON lines file log_path if given. With a profile_path, iteration
+        number profile_iteration is profiled.
+
+        backend selects the implementation of the force kernel, see
+        CartogramSolver. With coarse_vertices greater than zero, all but the
+        last iterations run on rings simplified to about that many vertices,
+        see CartogramSolver as well; this does not apply to streamed layers.
+
+        With preview_vertices greater than zero, a coarse outline of the
+        features with about that many vertices is emitted through the preview
+        signal after the iterations, along with the number of iterations
+        done. finish() stops after the current iteration and keeps its
+        result, kill() discards it.
+        """
         QObject.__init__(self)
 
         self.layer = layer
         self.field_name = field_name
         self.iterations = iterations
-
-        self.intermediateLayers = []
-
-        # used to store the computed minimum value when the input data contains
-        # zero or null values in the column used to create the cartogram
-        self.min_value = None
+        self.output_layer = output_layer
+        self.theta = theta
+        self.tolerance = tolerance
+        self.snap = snap
+        self.target_mean_error = target_mean_error
+        self.target_max_error = target_max_error
+        self.cache = cache
+        self.checkpoint_interval = checkpoint_interval
+        self.log = JsonLog(log_path) if log_path else None
+        self.profile_iteration = profile_iteration
+        self.profile_path = profile_path
+        self.export_path = export_path
+        self.export_driver = export_driver
+        self.precision = precision
+        self.stream = stream
+        self.backend = backend
+        self.preview_vertices = preview_vertices
+        self.coarse_vertices = coarse_vertices
+        self.grid_size = grid_size
+        self.grid_path = grid_path
+
+        # mean and max size error (in percent) before each iteration and after
+        # the last one
+        self.error_curve = []
+
+        # set by finish() to stop after the current iteration
+        self.stopping = False
+        self.last_preview = 0
+
+        # the computed minimum value of each field, used when the input data
+        # contains zero or null values in the column used to create the
+        # cartogram
+        self.min_values = []
 
         # set default exit code - if this doesn't change everything went well
         self.exit_code = -1
 
     def run(self):
         ret = None
+        coordinates = None
+        exporter = None
+
+        stopwatch = Stopwatch()
 
         try:
-            feature_count = self.layer.featureCount()
-
-            step = self.get_step()
-            steps = 0
-
-            for i in range(self.iterations):
-                self.feedback.emit("starting iteration {} of {}".format(i+1,self.iterations))
-                (meta_features,
-                    force_reduction_factor) = self.get_reduction_factor(
-                    self.layer, self.field_name)
-
-                inQueue=multiprocessing.Queue()
-                outQueue=multiprocessing.Queue()
-
-                for feature in self.layer.getFeatures():
-                    if self.exit_code > 0:
-                        break
-
-                    old_geometry = feature.geometry()
-                    #new_geometry = self.transform(meta_features, force_reduction_factor, old_geometry)
-
-                    inQueue.put((feature.id(),old_geometry.exportToWkt()))
-
-                threads=[]
-                for i in range(multiprocessing.cpu_count()+1):
-                    p=multiprocessing.Process(target=self.transform,args=(meta_features,force_reduction_factor,inQueue,outQueue))
-                    p.start()
-                    threads.append(p)
-
-                while True:
-                    try:
-                        (featureId,new_geometry)=outQueue.get(True,60)
-                    except Queue.Empty:
-                        break
-
-                    new_geometry=QgsGeometry().fromWkt(new_geometry)
-
-                    self.layer.dataProvider().changeGeometryValues({
-                        featureId : new_geometry})
-
-                    steps += 1
-                    if step == 0 or steps % step == 0:
-                        self.progress.emit(steps / float(feature_count) * 100)
-
-#                intermediateLayer = QgsVectorLayer(
-#                    "{geomType}?crs={crsId}".format(geomType=QGis.vectorGeometryType(self.layer.geometryType()),crsId=layer.crs().authid()),
-#                    "intermediate layer #{}".format(step),
-#                    "memory"
-#                )
-#                intermediateLayer.startEditing()
-#                intermediateLayer.dataProvider().addAttributes(
-#                    self.layer.dataprovider().fields().toList()
-#                )
-#                intermediateLayer.commitChanges()
-#
-#                for feature in self.layer.dataProvider().getFeatures():
-#                    intermediateLayer.dataProvider().addFeatures([feature])
-#                intermediateLayer.commitChanges()
-#
-#                self.intermediateLayers.append(intermediateLayer)
-
-#                writer = QgsVectorFileWriter(
-#                    "/tmp/intermediateLayer{}".format(step),
-#                    "utf-8",
-#                    self.layer.dataProvider().fields(),
-#                    self.layer.wkbType(),
-#                    self.layer.crs(),
-#                    "GeoJSON",
-#                    layerOptions=["COORDINATE_PRECISION=1"]
-#                )
-#                for f in self.layer.getFeatures():
-#                    writer.addFeature(f)
-#                del writer
-        
-        
-            if self.exit_code == -1:
+            # an unusable export format or path fails before the features
+            # are read and transformed
+            if self.export_path is not None:
+                exporter = self.create_exporter()
+
+            self.feedback.emit("reading features")
+            with stopwatch.measure('read'):
+                coordinates = self.read_features(self.layer,
+                    [self.field_name])
+
+            solver = CartogramSolver(coordinates, self.values[0],
+                self.iterations, profile_iteration=self.profile_iteration,
+                profile_path=self.profile_path, feedback=self.feedback.emit,
+                progress=self.progress.emit,
+                cancelled=lambda: self.exit_code > 0,
+                stopped=lambda: self.stopping,
+                iteration_finished=self.publish_preview
+                    if self.preview_vertices > 0 else None,
+                grid_path=self.grid_path, statistics=self.record,
+                **self.solver_options())
+
+            with stopwatch.measure('solve'):
+                solved = solver.run()
+
+            if solved and self.exit_code == -1:
+                self.error_curve = solver.error_curve
+
+                if not self.stream:
+                    self.feedback.emit("writing geometries")
+                    with stopwatch.measure('write'):
+                        if self.output_layer is None:
+                            self.write_geometries(self.layer, coordinates)
+                            ret = self.layer
+                        else:
+                            self.write_features(self.output_layer,
+                                coordinates)
+                            ret = self.output_layer
+
+                if exporter is not None:
+                    self.feedback.emit("exporting features")
+                    with stopwatch.measure('export'):
+                        self.export(exporter, coordinates)
+                        exporter.close()
+                        exporter = None
+
+                    if self.stream:
+                        ret = self.export_path
+
+                self.record({
+                    'type': 'job',
+                    'iterations': len(self.error_curve) - 1 +
+                        solver.error_curve_start,
+                    'mean_error': self.error_curve[-1][0],
+                    'max_error': self.error_curve[-1][1],
+                    'vertices': coordinates.vertex_count(),
+                    'stages': stopwatch.stages,
+                })
+
                 self.progress.emit(100)
-                ret = self.layer
         except Exception, e:
             self.error.emit(e, traceback.format_exc())
+        finally:
+            # the export file is only left behind if it is complete
+            if exporter is not None:
+                exporter.discard()
+            if coordinates is not None:
+                coordinates.close()
 
         self.finished.emit(ret, self.exit_code)
 
     def kill(self):
         self.exit_code = 1
 
-    def get_reduction_factor(self, layer, field):
-        """Calculate the reduction factor."""
-        data_provider = layer.dataProvider()
-        meta_features = []
+    def finish(self):
+        """Stop after the current iteration, and keep its result."""
+        self.stopping = True
+
+    def publish_preview(self, iterations, coordinates):
+        """Emit a coarse outline of the features after an iteration.
+
+        The snapshot has at most about preview_vertices vertices, and is
+        emitted at most once every PREVIEW_INTERVAL seconds, so that it costs
+        little time in the worker and does not flood the canvas.
+        """
+
+        if time.time() - self.last_preview < PREVIEW_INTERVAL:
+            return
+
+        step = int(math.ceil(coordinates.ring_vertex_count() /
+            float(self.preview_vertices)))
+        geometries = []
+        for index in range(coordinates.feature_count()):
+            polygons = coordinates.polygons(index, step)
+            if len(polygons) > 0:
+                geometries.append((index, QgsGeometry.fromMultiPolygon(
+                    [[[QgsPoint(x, y) for (x, y) in ring] for ring in polygon]
+                        for polygon in polygons])))
+
+        self.preview.emit(iterations, geometries)
+        self.last_preview = time.time()
+
+    def record(self, record):
+        """Emit a statistics record and append it to the log."""
+
+        record = dict(record)
+        record.setdefault('field', self.field_name)
+        self.statistics.emit(record)
+        if self.log is not None:
+            self.log.write(record)
+
+    def solver_options(self):
+        """Return the options of the solver, with distances in map units."""
+        return {
+            "theta": self.theta,
+            "tolerance": self.to_map_units(self.tolerance),
+            "target_mean_error": self.target_mean_error,
+            "target_max_error": self.target_max_error,
+            "cache": self.cache,
+            "checkpoint_interval": self.checkpoint_interval,
+            "backend": self.backend,
+            "coarse_vertices": self.coarse_vertices,
+            "grid_size": self.to_map_units(self.grid_size)
+        }
+
+    def to_map_units(self, distance):
+        """Convert a distance from metres to the map units of the layer."""
+        return distance * QGis.fromUnitToUnitFactor(QGis.Meters,
+            self.layer.crs().mapUnits())
+
+    def read_features(self, layer, fields):
+        """Read the geometries and values of all features in a single pass.
+
+        The vertices end up in a new coordinate buffer, the values of each of
+        the fields in self.values. Zero and NULL values are replaced by a
+        hundredth of the smallest valid value of their field. When streaming,
+        the vertices shared between rings are not merged.
+        """
+
+        self.feature_ids = []
+        self.feature_index = {}
+        self.source_values = [[] for field in fields]
+        values = [[] for field in fields]
+
+        def polygons(feature):
+            self.feature_index[feature.id()] = len(self.feature_ids)
+            self.feature_ids.append(feature.id())
+
+            for (i, field) in enumerate(fields):
+                value = feature.attribute(field)
+                self.source_values[i].append(value)
+                if type(value) is QPyNullVariant:
+                    value = None
+                values[i].append(value)
+
+            geometry = feature.geometry()
+            if geometry is None:
+                return []
+            if geometry.isMultipart():
+                polygons = geometry.asMultiPolygon()
+            else:
+                polygons = [geometry.asPolygon()]
+
+            return [[[(point.x(), point.y()) for point in line]
+                for line in polygon] for polygon in polygons]
+
+        coordinates = CoordinateBuffer.create((polygons(feature)
+            for feature in layer.dataProvider().getFeatures()),
+            self.to_map_units(self.snap), shared=not self.stream)
 
-        total_area = 0.0
-        total_value = 0.0
+        self.values = []
+        self.min_values = []
+        for field_values in values:
+            (field_values, min_value) = prepare_values(field_values)
+            self.values.append(field_values)
+            self.min_values.append(min_value)
 
-        if self.min_value is None:
-            self.min_value = self.get_min_value(data_provider, field)
+        shared = coordinates.ring_vertex_count() - coordinates.vertex_count()
+        self.feedback.emit(u"{} vertices, {} of them shared between "
+            u"rings".format(coordinates.ring_vertex_count(), shared))
 
-        for feature in data_provider.getFeatures():
-            meta_feature = CartogramFeature()
+        return coordinates
 
-            geometry = QgsGeometry(feature.geometry())
+    def geometries(self, coordinates):
+        """Yield the index, id and transformed geometry of every feature."""
 
-            area = QgsDistanceArea().measure(geometry)
-            total_area += area
+        for (index, feature_id) in enumerate(self.feature_ids):
+            polygons = [[[QgsPoint(x, y) for (x, y) in line]
+                for line in polygon]
+                for polygon in coordinates.polygons(index)]
+            if len(polygons) == 0:
+                continue
 
-            feature_value = feature.attribute(field)
-            if type(feature_value) is QPyNullVariant or feature_value == 0:
-                feature_value = self.min_value / 100
+            if len(polygons) == 1:
+                geometry = QgsGeometry.fromPolygon(polygons[0])
+            else:
+                geometry = QgsGeometry.fromMultiPolygon(polygons)
+
+            yield (index, feature_id, geometry)
 
-            total_value += feature_value
+    def output_fields(self, layer, field_name):
+        """Return the fields of an output layer: an id and the value field."""
 
-            meta_feature.area = area
-            meta_feature.value = feature_value
+        fields = QgsFields()
+        fields.append(QgsField('source_id', QVariant.Int))
+        fields.append(layer.fields()[layer.fieldNameIndex(field_name)])
 
-            centroid = geometry.centroid()
-            (cx, cy) = centroid.asPoint().x(), centroid.asPoint().y()
-            meta_feature.center_x = cx
-            meta_feature.center_y = cy
+        return fields
 
-            meta_features.append(meta_feature)
+    def write_geometries(self, layer, coordinates):
+        """Replace the geometries of the layer with the transformed ones.
 
-        fraction = total_area / total_value
+        The geometries are committed to the data provider in batches, and the
+        spatial index of the layer is only built once all of them are in
+        place.
+        """
+
+        data_provider = layer.dataProvider()
+        batch = {}
 
-        total_size_error = 0
+        for (index, feature_id, geometry) in self.geometries(coordinates):
+            batch[feature_id] = geometry
+            if len(batch) >= WRITE_BATCH_SIZE:
+                data_provider.changeGeometryValues(batch)
+                batch = {}
 
-        for meta_feature in meta_features:
-            polygon_value = meta_feature.value
-            polygon_area = meta_feature.area
+        if batch:
+            data_provider.changeGeometryValues(batch)
 
-            if polygon_area < 0:
-                polygon_area = 0
+        self.create_spatial_index(data_provider)
 
-            # this is our 'desired' area...
-            desired_area = polygon_value * fraction
+    def write_features(self, layer, coordinates, field=0):
+        """Add the transformed features to an (empty) output layer.
 
-            # calculate radius, a zero area is zero radius
-            radius = math.sqrt(polygon_area / math.pi)
-            meta_feature.radius = radius
+        Each feature gets the id of its source feature and its original value
+        of the given field (an index into the fields read), the geometries
+        come straight from the coordinate buffer.
+        """
 
-            if desired_area / math.pi > 0:
-                mass = math.sqrt(desired_area / math.pi) - radius
-                meta_feature.mass = mass
+        data_provider = layer.dataProvider()
+        fields = layer.fields()
+        batch = []
+
+        for (index, feature_id, geometry) in self.geometries(coordinates):
+            feature = QgsFeature(fields)
+            feature.setAttributes([feature_id,
+                self.source_values[field][index]])
+            feature.setGeometry(geometry)
+
+            batch.append(feature)
+            if len(batch) >= WRITE_BATCH_SIZE:
+                data_provider.addFeatures(batch)
+                batch = []
+
+        if batch:
+            data_provider.addFeatures(batch)
+
+        layer.updateExtents()
+        self.create_spatial_index(data_provider)
+
+    def create_exporter(self, frames=False):
+        """Create the export file of the job.
+
+        A full copy of the source layer passes on all of its attributes,
+        otherwise the features get the id of their source feature and the
+        value. With frames, the features of all frames of an animation go
+        into the one file, with the number and the field name of their frame
+        added to the attributes, and the values in a common value field.
+        """
+
+        if self.output_layer is None and not self.stream:
+            fields = QgsFields(self.layer.fields())
+        elif frames:
+            fields = QgsFields()
+            fields.append(QgsField('source_id', QVariant.Int))
+            fields.append(QgsField('value', QVariant.Double))
+        else:
+            fields = self.output_fields(self.layer, self.field_name)
+
+        if frames:
+            fields.append(QgsField('frame', QVariant.Int))
+            fields.append(QgsField('field', QVariant.String))
+
+        return FeatureExporter(self.export_path, self.export_driver, fields,
+            self.layer.crs(), self.precision)
+
+    def export(self, exporter, coordinates, field=0, frame=None):
+        """Write the transformed features of one field to an exporter.
+
+        field is an index into the fields read, frame the number of an
+        animation frame written to a multi-frame file.
+        """
+
+        full_copy = self.output_layer is None and not self.stream
+        if full_copy:
+            # the features come in the order in which they were read
+            request = QgsFeatureRequest()
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+            features = self.layer.dataProvider().getFeatures(request)
+
+        for (index, feature_id) in enumerate(self.feature_ids):
+            if full_copy:
+                attributes = next(features).attributes()
             else:
-                meta_feature.mass = 0
+                attributes = [feature_id, self.source_values[field][index]]
 
-            size_error = max(polygon_area, desired_area) / \
-                min(polygon_area, desired_area)
+            polygons = coordinates.polygons(index)
+            if len(polygons) == 0:
+                continue
 
-            total_size_error += size_error
+            if frame is not None:
+                attributes = attributes + [frame, self.field_names[frame]]
 
-        average_error = total_size_error / len(meta_features)
-        force_reduction_factor = 1 / (average_error + 1)
+            exporter.add(polygons, attributes)
 
-        return (meta_features, force_reduction_factor)
+    def create_spatial_index(self, data_provider):
+        """Build the spatial index, if the data provider supports one."""
+        if data_provider.capabilities() & \
+            QgsVectorDataProvider.CreateSpatialIndex:
+            data_provider.createSpatialIndex()
 
-    def transform(self, meta_features, force_reduction_factor, inQueue, outQueue):
-        """Transform the geometry based on the force reduction factor."""
 
-        while True:
-            try:
-                (featureId,geometry)=inQueue.get(False)
-            except Queue.Empty:
-                break
+class AnimationWorker(CartogramWorker):
+    """Background worker which creates one cartogram per field.
 
-            geometry=QgsGeometry().fromWkt(geometry)
+    The layer is read only once. By default each frame starts from its own
+    copy of the coordinate buffer; the frames are independent of each other
+    and are created in parallel by a pool of processes. With warm_start, the
+    frames are created one after another and each one continues from the
+    result of the previous one.
+    """
 
-            if geometry.isMultipart():
-                geometries = []
-                for polygon in geometry.asMultiPolygon():
-                    new_polygon = self.transform_polygon(polygon, meta_features,
-                        force_reduction_factor)
-                    geometries.append(new_polygon)
-                returnValue = QgsGeometry.fromMultiPolygon(geometries)
-            else:
-                polygon = geometry.asPolygon()
-                new_polygon = self.transform_polygon(polygon, meta_features,
-                    force_reduction_factor)
-                returnValue = QgsGeometry.fromPolygon(new_polygon)
+    def __init__(self, layers, field_names, iterations, output_layers,
+        processes=None, warm_start=False, **options):
+        """Constructor.
+
+        layers and output_layers hold one entry per field, as they would be
+        passed to CartogramWorker. The frames are created by the given number
+        of processes, by default one per CPU. All frames are exported to a
+        single file, see create_exporter().
 
-            outQueue.put((featureId,returnValue.exportToWkt()))
+        Consecutive frames of a time series usually differ only a little, so
+        warm started frames need far fewer iterations. Unless size error
+        targets are set, they stop as soon as they are as accurate as the
+        first frame.
+        """
+        CartogramWorker.__init__(self, layers[0], field_names[0], iterations,
+            output_layers[0], **options)
 
-    def transform_polygon(self, polygon, meta_features,
-        force_reduction_factor):
-        """Transform the geometry of a single polygon."""
+        self.layers = layers
+        self.field_names = field_names
+        self.output_layers = output_layers
+        self.processes = processes
+        self.warm_start = warm_start
 
-        new_line = []
-        new_polygon = []
+        self.error_curves = [None] * len(field_names)
 
-        whitelist=[] # list of centroids we got actual correction factors from for the first point of the polygon. let’s assume if we get <0.0 change, it is not going to influence ANY of the polygons points
+    def run(self):
+        ret = None
+        coordinates = None
+        frames = []
+        pool = None
+        exporter = None
 
-        for line in polygon:
-            for point in line:
-                x = x0 = point.x()
-                y = y0 = point.y()
+        try:
+            if self.export_path is not None:
+                exporter = self.create_exporter(True)
+
+            self.feedback.emit("reading features")
+            stopwatch = Stopwatch()
+            with stopwatch.measure('read'):
+                coordinates = self.read_features(self.layer, self.field_names)
+            self.record({'type': 'job', 'vertices': coordinates.vertex_count(),
+                'stages': stopwatch.stages})
+
+            if self.warm_start:
+                pool = create_pool(coordinates, self.processes)
+                results = self.warm_frames(coordinates, pool)
+            else:
+                frames = [coordinates.copy() for field in self.field_names]
+                pool = FramePool(coordinates, self.processes)
+                results = ((frame, frames[frame], error_curve)
+                    for (frame, error_curve) in pool.solve(
+                        zip(frames, self.values), self.iterations,
+                        self.solver_options(),
+                        cancelled=lambda: self.exit_code > 0))
+
+            finished = 0
+            for (frame, frame_coordinates, error_curve) in results:
+                if self.exit_code > 0:
+                    break
+
+                self.error_curves[frame] = error_curve
+                self.feedback.emit(u"frame {} ({}) finished with a mean size "
+                    u"error of {:.2f}% and a max size error of {:.2f}% after "
+                    u"{} iterations".format(frame + 1, self.field_names[frame],
+                        error_curve[-1][0], error_curve[-1][1],
+                        len(error_curve) - 1))
+
+                # the memory copies of the source layer are created the same
+                # way, so their feature ids match those of the first one
+                stopwatch = Stopwatch()
+                if not self.stream:
+                    with stopwatch.measure('write'):
+                        if self.output_layers[frame] is None:
+                            self.write_geometries(self.layers[frame],
+                                frame_coordinates)
+                        else:
+                            self.write_features(self.output_layers[frame],
+                                frame_coordinates, frame)
+                if exporter is not None:
+                    with stopwatch.measure('export'):
+                        self.export(exporter, frame_coordinates, frame, frame)
+
+                self.record({
+                    'type': 'frame',
+                    'field': self.field_names[frame],
+                    'frame': frame,
+                    'iterations': len(error_curve) - 1,
+                    'mean_error': error_curve[-1][0],
+                    'max_error': error_curve[-1][1],
+                    'stages': stopwatch.stages,
+                })
+
+                finished += 1
+                self.progress.emit(finished / float(len(self.layers)) * 100)
 
-                if len(whitelist)==0:
-                    featureList=meta_features
+            if self.exit_code == -1:
+                if self.stream:
+                    # the frames are told apart by their frame attribute
+                    ret = [self.export_path] * len(self.layers)
+                else:
+                    ret = [layer if output_layer is None else output_layer
+                        for (layer, output_layer)
+                        in zip(self.layers, self.output_layers)]
+        except Exception, e:
+            self.error.emit(e, traceback.format_exc())
+        finally:
+            # don't wait for outstanding frames after a failure or
+            # cancellation
+            if pool is not None:
+                if ret is not None:
+                    pool.close()
                 else:
-                    featureList=whitelist
-                # compute the influence of all shapes on this point
-                for feature in featureList:
-                    if feature.mass == 0:
-                        continue 
-                    cx = feature.center_x
-                    cy = feature.center_y
-                    dX=x0-cx
-                    dY=y0-cy
-                    distance = math.sqrt(dX ** 2 + dY ** 2)
-
-                    if (distance > feature.radius):
-                        # calculate the force exerted on points far away from
-                        # the centroid of this polygon
-                        force = feature.mass * feature.radius / distance
-                    else:
-                        # calculate the force exerted on points close to the
-                        # centroid of this polygon
-                        xF = distance / feature.radius
-                        # distance ** 2 / feature.radius ** 2 instead of xF
-                        force = feature.mass * (xF ** 2) * (4 - (3 * xF))
-                    force = force * force_reduction_factor / distance
-                    corrX=dX*force
-                    corrY=dY*force
-                    if sqrt(corrX**2 + corrY**2) > 0.1: # HUOM! that is assuming we’re dealing with meters here! does NOT work with geographic crs!
-                        x += corrX
-                        y += corrY
-                        whitelist.append(feature)
-                new_line.append(QgsPoint(x, y))
-            new_polygon.append(new_line)
-            new_line = []
-
-        return new_polygon
-
-    def get_step(self):
-        """Determine how often the progress bar should be updated."""
-
-        feature_count = self.layer.featureCount()
-
-        # update the progress bar at each .1% increment
-        step = feature_count // 1000
-
-        # because we use modulo to determine if we should emit the progress
-        # signal, the step needs to be greater than 1
-        if step < 2:
-            step = 2
-
-        return step
-
-    def get_min_value(self, data_provider, field):
-        features = []
-        for feature in data_provider.getFeatures():
-            feature_value = feature.attribute(field)
-            if not type(feature_value) is QPyNullVariant \
-                and feature_value != 0:
-                features.append(feature.attribute(field))
-
-        return min(features)
+                    pool.terminate()
+            if exporter is not None:
+                if ret is not None:
+                    exporter.close()
+                else:
+                    exporter.discard()
+            for frame in frames:
+                frame.close()
+            if coordinates is not None:
+                coordinates.close()
+
+        self.finished.emit(ret, self.exit_code)
+
+    def warm_frames(self, coordinates, pool):
+        """Create the frames in order, transforming a single buffer.
+
+        Yields the index, the coordinate buffer and the error curve of each
+        frame as soon as it is done; the buffer is only valid until the next
+        frame starts.
+        """
+
+        options = self.solver_options()
+        warm_options = dict(options)
+
+        for (frame, values) in enumerate(self.values):
+            solver = CartogramSolver(coordinates, values, self.iterations,
+                pool=pool, feedback=self.feedback.emit,
+                cancelled=lambda: self.exit_code > 0,
+                statistics=lambda record: self.record(dict(record,
+                    field=self.field_names[frame])),
+                **(warm_options if frame > 0 else options))
+            if not solver.run():
+                return
+
+            if frame == 0 and options["target_mean_error"] <= 0 and \
+                options["target_max_error"] <= 0:
+                (warm_options["target_mean_error"],
+                    warm_options["target_max_error"]) = solver.error_curve[-1]
+
+            yield (frame, coordinates, solver.error_curve)